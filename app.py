@@ -1,48 +1,424 @@
-from flask import Flask, render_template
+from collections import OrderedDict
+from datetime import datetime, timezone
+from flask import (
+    Flask, Response, render_template, request, make_response, jsonify,
+)
 import redis
+import gzip
+import hashlib
 import json
-import os
+import math
+import queue
+import threading
+import time
+
+import metrics
+import profiling
+from config import config
+from db import r, read
+from listings import FIELDS, decode_stored_listing
+from treasures import DELTAS_CHANNEL, SORTS, read_treasures
 
 
 app = Flask(__name__)
 
-app.config.from_object('settings')
+app.config.update(config)
+
+profiling.profile_requests(app)
+
+# Rendered index pages keyed on ranking version and sort, least recently used
+# first
+page_cache = OrderedDict()
+
+# Queues of rank delta messages for each connected stream, and the thread
+# filling them from DELTAS_CHANNEL
+stream_queues = set()
+stream_lock = threading.Lock()
+stream_thread = None
+
+
+def get_treasures(sort='value', client=r, snapshot=None):
+    """Returns the top treasures, preferring the snapshot built by workers.
+
+    The snapshot is read from client unless it's given.
+    """
+    if sort == 'value':
+        if snapshot is None:
+            snapshot = client.get('treasures.snapshot')
+
+        if snapshot is not None:
+            return json.loads(snapshot)
+
+    return read_treasures(config.get('BT_TOP_COUNT', 100), sort, client)
+
+
+def render_index(sort='value', version=None, client=r, snapshot=None):
+    """Renders the index page."""
+    with metrics.timer('bt_web_duration_seconds', stage='get_treasures'):
+        treasures = get_treasures(sort, client, snapshot)
+
+    with metrics.timer('bt_web_duration_seconds', stage='render'):
+        return render_template(
+            'index.html', treasures=treasures, sort=sort, version=version,
+        )
 
 
-def get_redis():
-    """Get a Redis connection."""
-    return redis.Redis(
-        host=app.config['REDIS_CONFIG'].hostname,
-        port=app.config['REDIS_CONFIG'].port,
-        password=app.config['REDIS_CONFIG'].password,
+def get_page(version, sort='value', client=r):
+    """Returns the rendered index page for a ranking version, caching it.
+
+    A page that isn't cached is rendered from a snapshot read in one MGET
+    with its version, so a worker update in between can't file the newer
+    ranking under the older version. The page may be for a newer version
+    than the one asked for.
+    """
+    page = page_cache.get((version, sort))
+
+    if page is not None:
+        page_cache.move_to_end((version, sort))
+        return page
+
+    version, updated, snapshot = client.mget(
+        'treasures.version', 'treasures.updated', 'treasures.snapshot',
     )
+    html = render_index(sort, int(version), client, snapshot).encode('utf-8')
+
+    page = {
+        'html': html,
+        'gzip': gzip.compress(html),
+        'etag': hashlib.sha1(html).hexdigest(),
+        'updated': datetime.fromtimestamp(
+            float(updated) if updated is not None else time.time(),
+            timezone.utc,
+        ),
+    }
+
+    page_cache[(version, sort)] = page
+    while len(page_cache) > config.get('BT_PAGE_CACHE_SIZE', 8):
+        page_cache.popitem(last=False)
+
+    return page
+
+
+def parse_cursor(cursor):
+    """Returns the score, tie offset and listing id in a treasures API cursor.
+
+    Raises ValueError if the score isn't a finite number, which Redis won't
+    take as a range, or the offset isn't a positive count.
+    """
+    score, offset, listing_id = cursor.split(':', 2)
+    score = float(score)
+    offset = int(offset)
+
+    if not math.isfinite(score):
+        raise ValueError('Cursor score must be finite: %r' % score)
+    if offset < 1:
+        raise ValueError('Cursor offset must be positive: %r' % offset)
+
+    return score, offset, listing_id.encode('utf-8')
+
+
+def format_cursor(page, cursor=None):
+    """Returns the cursor for the page after page, which followed cursor.
+
+    It holds the last listing's score and id, and the offset of the listing
+    after it among those with the same score. The next page can then read
+    the remaining ties in the range, rather than all of them.
+    """
+    listing_id, score = page[-1]
+
+    offset = 0
+    for _, tied_score in reversed(page):
+        if tied_score != score:
+            break
+        offset += 1
+
+    # The whole page was ties with the last cursor
+    if cursor is not None and cursor[0] == score:
+        offset += cursor[1]
+
+    return '%r:%d:%s' % (score, offset, listing_id.decode('utf-8'))
+
+
+def read_page(sort, cursor, limit, client=r):
+    """Reads a page of treasure ids and scores in a sort order, after cursor.
+
+    Listings with the same score are ordered by id, as the range commands
+    order them, so a cursor always points at a single place in the ranking.
+    Ties are read from the cursor's offset, skipping any listing at or
+    before its id in case others were tied since. Returns the page and
+    whether there is more after it.
+    """
+    key, descending = SORTS[sort]
+
+    if cursor is None:
+        page = (client.zrevrange if descending else client.zrange)(
+            key, 0, limit, withscores=True,
+        )
+
+        return page[:limit], len(page) > limit
+
+    score, offset, listing_id = cursor
+
+    # Ties with the cursor's listing, then everything scored past it
+    pipe = client.pipeline(transaction=False)
+    if descending:
+        pipe.zrevrangebyscore(
+            key, score, score, start=offset, num=limit + 1, withscores=True,
+        )
+        pipe.zrevrangebyscore(
+            key, '(%r' % score, '-inf', start=0, num=limit + 1,
+            withscores=True,
+        )
+    else:
+        pipe.zrangebyscore(
+            key, score, score, start=offset, num=limit + 1, withscores=True,
+        )
+        pipe.zrangebyscore(
+            key, '(%r' % score, '+inf', start=0, num=limit + 1,
+            withscores=True,
+        )
+    ties, rest = pipe.execute()
+
+    page = [
+        tie for tie in ties
+        if (tie[0] < listing_id if descending else tie[0] > listing_id)
+    ] + rest
+
+    return page[:limit], len(page) > limit
+
+
+def cache_for_version(response, etag):
+    """Adds the caching headers for an API response."""
+    if etag is not None:
+        response.set_etag(etag)
+
+    response.cache_control.public = True
+    response.cache_control.max_age = config.get('BT_TREASURES_MAX_AGE')
+
+    return response
+
+
+def treasures_page(client, sort, cursor, limit, fields):
+    """Returns a page of treasures as a JSON response, reading from client."""
+    # Pages only change with the ranking, so the version is all a client
+    # needs to revalidate, without reading the ranking at all
+    version = client.get('treasures.version')
+    etag = None
+    if version is not None:
+        etag = hashlib.sha1(b'%s?%s' % (
+            version, request.query_string,
+        )).hexdigest()
+
+        if etag in request.if_none_match:
+            return cache_for_version(make_response('', 304), etag)
 
+    page, more = read_page(sort, cursor, limit, client)
 
-r = get_redis()
+    # Other sorts page by their own field, so scores are read separately
+    pipe = client.pipeline(transaction=False)
+    for listing_id, _ in page:
+        pipe.get(b'listings.%s.data' % listing_id)
+        if sort != 'value':
+            pipe.zscore('treasures', listing_id)
+    results = pipe.execute()
+    if sort == 'value':
+        scores = [score for _, score in page]
+    else:
+        results, scores = results[::2], results[1::2]
 
+    treasures = []
+    for (listing_id, _), data, score in zip(page, results, scores):
+        # Trimmed or purged since the page was read
+        treasure = decode_stored_listing(listing_id, data)
+        if treasure is None or score is None:
+            continue
 
-def get_treasures():
-    treasure_ids = r.zrevrange('treasures', 0, 99)
-    treasure_keys = map(
-        lambda s: 'listings.' + s.decode('utf-8') + '.data',
-        treasure_ids,
+        treasure['score'] = score
+        treasures.append({field: treasure[field] for field in fields})
+
+    next_cursor = format_cursor(page, cursor) if more else None
+
+    return cache_for_version(
+        jsonify(treasures=treasures, next=next_cursor), etag,
+    )
+
+
+@app.route('/api/treasures')
+def api_treasures():
+    """Returns a page of treasures as JSON, best first unless sorted.
+
+    Takes a sort from SORTS, a cursor from the previous page's next, a limit
+    of up to BT_TREASURES_MAX_PAGE_SIZE and a comma separated list of fields.
+    """
+    sort = request.args.get('sort', 'value')
+    if sort not in SORTS:
+        return jsonify(error='Unknown sort: %s' % sort), 400
+
+    try:
+        limit = int(request.args.get(
+            'limit', config.get('BT_TREASURES_PAGE_SIZE'),
+        ))
+        cursor = request.args.get('cursor')
+        if cursor is not None:
+            cursor = parse_cursor(cursor)
+    except ValueError:
+        return jsonify(error='Bad limit or cursor'), 400
+
+    if not 0 < limit <= config.get('BT_TREASURES_MAX_PAGE_SIZE'):
+        return jsonify(error='Bad limit or cursor'), 400
+
+    fields = request.args.get('fields')
+    fields = FIELDS + ('score',) if fields is None else tuple(
+        field for field in fields.split(',') if field
+    )
+    unknown = set(fields) - set(FIELDS + ('score',))
+    if unknown:
+        return jsonify(
+            error='Unknown fields: %s' % ', '.join(sorted(unknown)),
+        ), 400
+
+    return read(lambda client: treasures_page(
+        client, sort, cursor, limit, fields,
+    ))
+
+
+def broadcast(message):
+    """Queues a rank delta message for every connected stream.
+
+    Streams that have fallen too far behind are dropped, so one slow client
+    can't hold up the rest. Their browsers reconnect and catch up by
+    reloading.
+    """
+    with stream_lock:
+        queues = list(stream_queues)
+
+    for stream_queue in queues:
+        try:
+            stream_queue.put_nowait(message)
+        except queue.Full:
+            with stream_lock:
+                stream_queues.discard(stream_queue)
+
+
+def fan_out():
+    """Broadcasts rank deltas from Redis, resubscribing if Redis goes away.
+
+    Each web process holds one subscription however many streams it serves.
+    """
+    while True:
+        try:
+            pubsub = r.pubsub(ignore_subscribe_messages=True)
+            pubsub.subscribe(DELTAS_CHANNEL)
+
+            for message in pubsub.listen():
+                broadcast(message['data'].decode('utf-8'))
+        except redis.ConnectionError:
+            app.logger.warning('Lost the rank delta subscription, retrying')
+            time.sleep(1)
+
+
+def start_fan_out():
+    """Starts the fan out thread, once per process."""
+    global stream_thread
+
+    with stream_lock:
+        if stream_thread is None or not stream_thread.is_alive():
+            stream_thread = threading.Thread(target=fan_out, daemon=True)
+            stream_thread.start()
+
+
+def stream_deltas(stream_queue):
+    """Yields Server-Sent Events from a stream's queue until it's dropped."""
+    keepalive = config.get('BT_STREAM_KEEPALIVE')
+
+    try:
+        yield 'retry: 5000\n\n'
+
+        while stream_queue in stream_queues or not stream_queue.empty():
+            try:
+                message = stream_queue.get(timeout=keepalive)
+            except queue.Empty:
+                # Keeps proxies from closing an idle connection
+                yield ': keepalive\n\n'
+                continue
+
+            yield 'data: %s\n\n' % message
+    finally:
+        with stream_lock:
+            stream_queues.discard(stream_queue)
+
+
+@app.route('/stream')
+def stream():
+    """Streams rank deltas for the top treasures as Server-Sent Events.
+
+    Each message has the ranking version it leads to. Under the eventlet
+    worker every stream is a green thread, so idle connections are cheap.
+    """
+    stream_queue = queue.Queue(config.get('BT_STREAM_QUEUE_SIZE'))
+
+    with stream_lock:
+        stream_queues.add(stream_queue)
+    start_fan_out()
+
+    response = Response(
+        stream_deltas(stream_queue), mimetype='text/event-stream',
     )
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+
+    return response
+
+
+@app.after_request
+def flush_metrics(response):
+    metrics.flush(r, config.get('BT_METRICS_FLUSH_INTERVAL'))
+
+    return response
+
+
+@app.route('/metrics')
+def metrics_text():
+    """Returns metrics from every process in the Prometheus text format."""
+    metrics.flush(r)
+
+    return make_response(metrics.render(r), 200, {
+        'Content-Type': 'text/plain; version=0.0.4; charset=utf-8',
+    })
+
+
+def index_page(client, sort):
+    """Returns the index page as a response, reading from client."""
+    version = client.get('treasures.version')
+
+    # Nothing has been ranked by the workers yet, so there's nothing to key on
+    if version is None:
+        return render_index(sort, client=client)
+
+    page = get_page(version, sort, client)
+
+    # A quality of 0 means the client refuses gzip
+    if request.accept_encodings['gzip'] > 0:
+        response = make_response(page['gzip'])
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(page['etag'] + '-gzip')
+    else:
+        response = make_response(page['html'])
+        response.set_etag(page['etag'])
 
-    pipe = r.pipeline()
-    for treasure_key in treasure_keys:
-        pipe.get(treasure_key)
+    response.vary.add('Accept-Encoding')
+    response.last_modified = page['updated']
 
-    return [
-        json.loads(data) for data in pipe.execute()
-        if data is not None
-    ]
+    return response.make_conditional(request)
 
 
 @app.route('/')
 def index():
-    treasures = get_treasures()
+    sort = request.args.get('sort', 'value')
+    if sort not in SORTS:
+        sort = 'value'
 
-    return render_template('index.html', treasures=treasures, sort='value')
+    return read(lambda client: index_page(client, sort))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,50 @@
+"""
+Compares two sets of results from benchmarks/pipeline.py:
+
+    python benchmarks/compare.py before.json after.json
+
+Prints each benchmark's throughput and p95 latency side by side, with the
+change from before to after.
+"""
+import argparse
+import json
+
+
+def change(before, after):
+    """Returns the change from before to after as a percentage."""
+    return (after - before) / before * 100 if before else float('nan')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('before')
+    parser.add_argument('after')
+    args = parser.parse_args()
+
+    with open(args.before) as before_file, open(args.after) as after_file:
+        before = json.load(before_file)
+        after = json.load(after_file)
+
+    print('%s -> %s' % (
+        (before.get('commit') or '?')[:10], (after.get('commit') or '?')[:10],
+    ))
+    print('%-22s %12s %12s %8s %10s %10s %8s' % (
+        '', 'items/s', '', '', 'p95 ms', '', '',
+    ))
+
+    for name, old in sorted(before['results'].items()):
+        new = after['results'].get(name)
+        if new is None:
+            continue
+
+        print('%-22s %12.1f %12.1f %+7.1f%% %10.2f %10.2f %+7.1f%%' % (
+            name,
+            old['throughput'], new['throughput'],
+            change(old['throughput'], new['throughput']),
+            old['p95_ms'], new['p95_ms'],
+            change(old['p95_ms'], new['p95_ms']),
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+A local stand-in for the parts of the Etsy API the workers call, serving
+synthetic treasuries and listings:
+
+    python benchmarks/fake_etsy.py [--listings 100000] [--port 8000]
+
+Point API_SERVER at it (with a trailing slash) to run the workers against it.
+Each first page of treasuries reveals --new-treasuries more, as if users had
+been busy since the last poll.
+"""
+import argparse
+import json
+import random
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from listing_storage import fake_listing
+
+
+# Etsy listing ids are integers in the hundreds of millions
+FIRST_LISTING_ID = 10 ** 8
+
+
+class FakeEtsy(object):
+    """Synthetic treasuries and listings, the same for the same arguments."""
+    def __init__(self, listings, new_treasuries=100, treasury_size=8,
+                 users=100000, dead_rate=0.05):
+        self.listings = listings
+        self.new_treasuries = new_treasuries
+        self.treasury_size = treasury_size
+        self.users = users
+        self.dead_rate = dead_rate
+        self.latest = 0
+        self.lock = threading.Lock()
+
+    def treasury(self, treasury_id):
+        """Returns a treasury of listings, mostly from the tracked catalog."""
+        rng = random.Random(treasury_id)
+
+        # A tenth of listings are ones nobody has tracked yet
+        catalog = int(self.listings * 1.1)
+
+        return {
+            'id': treasury_id,
+            'creation_tsz': 1500000000 + treasury_id,
+            'user_id': rng.randrange(self.users),
+            'listings': [
+                {'data': {'listing_id': FIRST_LISTING_ID + listing_id}}
+                for listing_id in rng.sample(
+                    range(catalog), min(self.treasury_size, catalog),
+                )
+            ],
+        }
+
+    def treasuries(self, limit, offset):
+        """Returns a page of treasuries, newest first."""
+        with self.lock:
+            if offset == 0:
+                self.latest += self.new_treasuries
+            latest = self.latest
+
+        newest = latest - offset
+
+        return [
+            self.treasury(treasury_id) for treasury_id in
+            range(newest, max(newest - limit, 0), -1)
+        ]
+
+    def listing(self, listing_id):
+        """Returns a listing's details, some of them no longer for sale."""
+        rng = random.Random(listing_id)
+        listing = fake_listing(listing_id)
+        del listing['users']
+
+        if rng.random() < self.dead_rate:
+            listing['state'] = 'sold_out'
+
+        return listing
+
+
+def handler(etsy):
+    """Returns a request handler class serving etsy."""
+    class FakeEtsyHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            params = parse_qs(url.query)
+            listings = re.search(r'/listings/([\d,]+)$', url.path)
+
+            if url.path.endswith('/treasuries'):
+                results = etsy.treasuries(
+                    int(params.get('limit', ['25'])[0]),
+                    int(params.get('offset', ['0'])[0]),
+                )
+            elif listings:
+                results = [
+                    etsy.listing(int(listing_id))
+                    for listing_id in listings.group(1).split(',')
+                ]
+            else:
+                self.send_error(404)
+                return
+
+            body = json.dumps({
+                'count': len(results),
+                'results': results,
+            }).encode('utf-8')
+
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    return FakeEtsyHandler
+
+
+def serve(etsy, port=0):
+    """Serves etsy from a background thread, returning the server."""
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler(etsy))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--listings', type=int, default=100000)
+    parser.add_argument('--new-treasuries', type=int, default=100)
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', args.port), handler(
+        FakeEtsy(args.listings, new_treasuries=args.new_treasuries),
+    ))
+    print('Serving a fake Etsy API at http://127.0.0.1:%s/' % args.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
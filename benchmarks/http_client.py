@@ -0,0 +1,78 @@
+"""
+Compares a bare requests.get against the pooled API session.
+
+Serves a canned listings response from a local keep-alive HTTP server and
+reports requests per second for each client:
+
+    python benchmarks/http_client.py [--requests 2000]
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from tasks import get_session  # noqa: E402
+
+
+BODY = json.dumps({
+    'count': 1,
+    'results': [{'listing_id': 1, 'state': 'active'}],
+}).encode('utf-8')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers every GET with the same small JSON body."""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+def requests_per_second(get, url, count):
+    """Returns how many GETs per second get manages against url."""
+    start = time.perf_counter()
+    for _ in range(count):
+        get(url, timeout=(3.05, 30)).json()
+
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%s/listings/1' % server.server_port
+
+    results = {
+        'requests.get': requests_per_second(requests.get, url, args.requests),
+        'pooled session': requests_per_second(
+            get_session().get, url, args.requests,
+        ),
+    }
+
+    server.shutdown()
+
+    for name, rate in results.items():
+        print('%-16s %8.1f req/s' % (name, rate))
+
+
+if __name__ == '__main__':
+    main()
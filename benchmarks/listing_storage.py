@@ -0,0 +1,90 @@
+"""
+Compares stored listing size and decode time for whole API listings against
+the compact format:
+
+    python benchmarks/listing_storage.py [--listings 10000]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from listings import decode_listing, encode_listing  # noqa: E402
+
+
+def fake_listing(listing_id):
+    """A listing shaped like what the API returns for get_listing_data."""
+    return {
+        'listing_id': listing_id,
+        'state': 'active',
+        'title': (
+            'Hand forged %s pendant with antique brass chain and tiny '
+            'gemstone accents' % random.choice(['silver', 'gold'])
+        ),
+        'url': (
+            'https://www.etsy.com/listing/%s/hand-forged-pendant-with-'
+            'antique-brass-chain?utm_source=buriedtreasure' % listing_id
+        ),
+        'price': '%.2f' % random.uniform(5, 500),
+        'currency_code': 'USD',
+        'views': random.randint(1, 5000),
+        'quantity': random.randint(1, 20),
+        'materials': random.sample([
+            'silver', 'gold', 'brass', 'copper', 'gemstone', 'leather',
+            'cotton', 'wood', 'glass', 'clay',
+        ], 5),
+        'original_creation_tsz': random.randint(1200000000, 1600000000),
+        'users': random.randint(2, 40),
+        'Shop': {
+            'shop_id': random.randint(1, 10 ** 7),
+            'shop_name': 'TreasureForge%s' % random.randint(1, 999),
+            'url': 'https://www.etsy.com/shop/TreasureForge?utm_source=bt',
+        },
+        'Images': [{
+            'listing_image_id': random.randint(1, 10 ** 9),
+            'listing_id': listing_id,
+            'url_170x135': (
+                'https://img0.etsystatic.com/000/0/%s/il_170x135.%s.jpg' % (
+                    listing_id, random.randint(1, 10 ** 9),
+                )
+            ),
+        }],
+    }
+
+
+def measure(name, encoded, decode):
+    """Prints the average size and decode time of encoded listings."""
+    size = sum(len(data) for data in encoded) / len(encoded)
+
+    # Best of a few runs, to keep other processes out of the numbers
+    elapsed = min(
+        timeit.timeit(lambda: [decode(data) for data in encoded], number=1)
+        for _ in range(5)
+    )
+
+    print('%-8s %7.1f bytes/listing %7.2f us/decode' % (
+        name, size, elapsed / len(encoded) * 10 ** 6,
+    ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--listings', type=int, default=10000)
+    args = parser.parse_args()
+
+    listings = [fake_listing(i) for i in range(args.listings)]
+
+    measure('legacy', [
+        json.dumps(listing).encode('utf-8') for listing in listings
+    ], json.loads)
+    measure('compact', [
+        encode_listing(listing) for listing in listings
+    ], decode_listing)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,248 @@
+"""
+Measures the pipeline end to end against a local fake Etsy API and a seeded
+Redis database:
+
+    python benchmarks/pipeline.py [--listings 100000] [--output results.json]
+
+Reports throughput and latency for fetch_listings, fetch_detail,
+scrub_scrubs, get_treasures and rendering /. With --output the results are
+also written as JSON, which benchmarks/compare.py compares across commits.
+
+Needs a real Redis server at REDISCLOUD_URL. The chosen database is flushed
+before seeding and after the run.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy  # noqa: E402
+
+from app import app, get_treasures, page_cache  # noqa: E402
+from config import config  # noqa: E402
+from db import r  # noqa: E402
+from fake_etsy import FIRST_LISTING_ID, FakeEtsy, serve  # noqa: E402
+from listing_storage import fake_listing  # noqa: E402
+from listings import encode_listing  # noqa: E402
+from treasures import SORT_FIELDS  # noqa: E402
+import tasks  # noqa: E402
+
+
+def use_database(db):
+    """Points the shared Redis client at another database."""
+    r.connection_pool.connection_kwargs['db'] = db
+    r.connection_pool.reset()
+
+
+def seed(listings, scored, single_rate, batch_size=10000):
+    """Stores tracked listings the way the workers leave them.
+
+    single_rate of the listings have one user and the rest several, and the
+    first scored of those have data, scores and sort indexes.
+    """
+    r.flushdb()
+    now = time.time()
+    rng = random.Random(0)
+
+    remaining = scored
+    for start in range(0, listings, batch_size):
+        pipe = r.pipeline(transaction=False)
+        stored = []
+
+        for listing_id in range(
+            FIRST_LISTING_ID + start,
+            FIRST_LISTING_ID + min(start + batch_size, listings),
+        ):
+            if rng.random() < single_rate:
+                pipe.hset(
+                    tasks.first_user_key(listing_id), listing_id,
+                    rng.randrange(10 ** 6),
+                )
+                pipe.zadd('listings.single', {
+                    listing_id: now - rng.uniform(0, 86400 * 30),
+                })
+                continue
+
+            pipe.sadd('listings.%s.users' % listing_id, *rng.sample(
+                range(10 ** 6), rng.randint(2, 10),
+            ))
+
+            if remaining > 0:
+                listing = fake_listing(listing_id)
+                stored.append(listing)
+                pipe.set(
+                    'listings.%s.data' % listing_id, encode_listing(listing),
+                )
+                pipe.zadd('listings.fetched', {listing_id: now})
+                remaining -= 1
+
+        if stored:
+            scores = tasks.calculate_scores(
+                numpy.array([item['users'] for item in stored], float),
+                numpy.array(
+                    ['gold' in item['materials'] for item in stored], float,
+                ),
+                numpy.array([item['views'] for item in stored], float),
+                numpy.array([item['quantity'] for item in stored], float),
+                numpy.array(
+                    [item['original_creation_tsz'] for item in stored], float,
+                ),
+                now,
+            )
+            pipe.zadd('treasures', {
+                listing['listing_id']: float(score)
+                for listing, score in zip(stored, scores)
+            })
+            for field in SORT_FIELDS:
+                pipe.zadd('treasures.%s' % field, {
+                    listing['listing_id']: float(listing[field])
+                    for listing in stored
+                })
+
+        pipe.execute()
+
+    tasks.update_snapshot()
+
+
+def measure(name, run, runs, items=1, before=None):
+    """Times runs calls of run, returning throughput and latency.
+
+    items is how many things each call handles. before is called ahead of
+    each run, outside the timing.
+    """
+    latencies = []
+    for _ in range(runs):
+        if before is not None:
+            before()
+
+        start = time.perf_counter()
+        run()
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+    total = sum(latencies)
+    result = {
+        'runs': runs,
+        'items_per_run': items,
+        'seconds': total,
+        'throughput': runs * items / total,
+        'p50_ms': latencies[len(latencies) // 2] * 1000,
+        'p95_ms': latencies[min(int(len(latencies) * 0.95), runs - 1)] * 1000,
+        'max_ms': latencies[-1] * 1000,
+    }
+
+    print('%-22s %10.1f items/s %9.2f ms p50 %9.2f ms p95 %9.2f ms max' % (
+        name, result['throughput'], result['p50_ms'], result['p95_ms'],
+        result['max_ms'],
+    ))
+
+    return result
+
+
+def commit():
+    """Returns the checked out commit, if there is one."""
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            cwd=os.path.dirname(__file__),
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--listings', type=int, default=100000,
+                        help='tracked listings to seed, 10k to 1M')
+    parser.add_argument('--scored', type=int, default=10000,
+                        help='tracked listings with data and scores')
+    parser.add_argument('--single-rate', type=float, default=0.7)
+    parser.add_argument('--new-treasuries', type=int, default=100,
+                        help='treasuries created between polls')
+    parser.add_argument('--runs', type=int, default=20)
+    parser.add_argument('--db', type=int, default=15)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    use_database(args.db)
+
+    etsy = FakeEtsy(args.listings, new_treasuries=args.new_treasuries)
+    server = serve(etsy)
+
+    config.update({
+        'API_SERVER': 'http://127.0.0.1:%s/' % server.server_port,
+        'BT_LISTING_LIMIT': args.scored,
+        # The fake API has no quota, so the rate limiter never waits
+        'BT_API_RATE': 10 ** 6,
+        'BT_API_MAX_RATE': 10 ** 6,
+        'BT_API_BURST': 10 ** 6,
+    })
+    app.testing = True
+    client = app.test_client()
+
+    # Run fetch_detail chunks inline, as part of fetch_listings
+    tasks.celery.conf.task_always_eager = True
+
+    print('Seeding %s listings...' % args.listings)
+    start = time.perf_counter()
+    seed(args.listings, args.scored, args.single_rate)
+    print('Seeded in %.1fs' % (time.perf_counter() - start))
+
+    chunk_size = config.get('BT_CHUNK_SIZE', 50)
+    chunks = iter(range(
+        FIRST_LISTING_ID, FIRST_LISTING_ID + args.listings, chunk_size,
+    ))
+
+    def fetch_detail():
+        start = next(chunks)
+        tasks.fetch_detail(*range(start, start + chunk_size))
+
+    results = {}
+    results['fetch_listings'] = measure(
+        'fetch_listings', tasks.fetch_listings, args.runs,
+        items=args.new_treasuries,
+    )
+    results['fetch_detail'] = measure(
+        'fetch_detail', fetch_detail, args.runs, items=chunk_size,
+    )
+    results['scrub_scrubs'] = measure(
+        'scrub_scrubs', tasks.scrub_scrubs, 1,
+        items=r.zcard('listings.single'),
+    )
+    results['get_treasures'] = measure(
+        'get_treasures', get_treasures, args.runs * 10,
+    )
+    results['get_treasures_views'] = measure(
+        'get_treasures (views)', lambda: get_treasures('views'),
+        args.runs * 10,
+    )
+    results['index_cached'] = measure(
+        '/ (cached)', lambda: client.get('/'), args.runs * 10,
+    )
+    results['index_render'] = measure(
+        '/ (render)', lambda: client.get('/'), args.runs * 10,
+        before=page_cache.clear,
+    )
+
+    server.shutdown()
+    r.flushdb()
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({
+                'commit': commit(),
+                'time': time.time(),
+                'python': platform.python_version(),
+                'params': vars(args),
+                'results': results,
+            }, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
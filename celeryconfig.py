@@ -34,14 +34,32 @@ beat_schedule = {
         'task': 'tasks.fetch_listings',
         'schedule': timedelta(minutes=5),
     },
+    'flush_listings': {
+        'task': 'tasks.flush_listings',
+        'schedule': timedelta(minutes=1),
+    },
+    'refresh_treasures': {
+        'task': 'tasks.refresh_treasures',
+        'schedule': timedelta(minutes=10),
+    },
+    'rescore_treasures': {
+        'task': 'tasks.rescore_treasures',
+        'schedule': timedelta(minutes=10),
+    },
+    'trim_treasures': {
+        'task': 'tasks.trim_treasures',
+        'schedule': timedelta(minutes=5),
+    },
     'scrub_scrubs': {
         'task': 'tasks.scrub_scrubs',
         'schedule': timedelta(minutes=1),
     },
 }
 
+# API calls are rate limited across all workers by ratelimit.acquire, so this
+# per-worker limit is off unless it's set explicitly
 task_annotations = {
     'tasks.fetch_detail': {
-        'rate_limit': os.environ.get('FETCH_DETAIL_RATE', '5/m'),
+        'rate_limit': os.environ.get('FETCH_DETAIL_RATE'),
     }
 }
@@ -0,0 +1,8 @@
+import settings
+
+
+# Settings shared by the web app and the workers. Workers read them from here
+# rather than from the Flask app, so they never have to import Flask.
+config = {
+    name: getattr(settings, name) for name in dir(settings) if name.isupper()
+}
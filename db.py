@@ -0,0 +1,134 @@
+import itertools
+import logging
+import os
+import queue
+import time
+from functools import partial
+
+import redis
+from redis.commands.core import Script
+
+import metrics
+from config import config
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_redis(url=None, timeout=None):
+    """Get a Redis connection, to the primary unless given a replica's URL.
+
+    Commands wait up to timeout seconds for an answer, or forever if it's
+    None, as the primary's pubsub connection must.
+    """
+    if url is None:
+        url = config['REDIS_CONFIG']
+
+    return redis.Redis(connection_pool=redis.BlockingConnectionPool(
+        host=url.hostname,
+        port=url.port,
+        password=url.password,
+        max_connections=config.get('BT_REDIS_MAX_CONNECTIONS'),
+        timeout=config.get('BT_REDIS_POOL_TIMEOUT'),
+        socket_connect_timeout=config.get('BT_REDIS_CONNECT_TIMEOUT'),
+        socket_timeout=timeout,
+        health_check_interval=config.get('BT_REDIS_HEALTH_CHECK_INTERVAL'),
+    ))
+
+
+class LazyRedis(object):
+    """A Redis client for the current process, made when it's first used.
+
+    Importing never connects, and a forked process makes its own client and
+    pool rather than sharing its parent's.
+    """
+    def __init__(self, factory):
+        self.factory = factory
+        self.client = None
+        self.pid = None
+
+    def get_client(self):
+        pid = os.getpid()
+
+        if self.client is None or self.pid != pid:
+            self.client = self.factory()
+            self.pid = pid
+
+        return self.client
+
+    def register_script(self, script):
+        # Scripts hold on to this proxy rather than a client, and taking bytes
+        # saves them asking a client for its encoding
+        return Script(self, script.encode('utf-8'))
+
+    def __getattr__(self, name):
+        return getattr(self.get_client(), name)
+
+
+r = LazyRedis(get_redis)
+
+# Clients for the read-only replicas, and the time each one that couldn't be
+# reached is skipped until
+replicas = [
+    LazyRedis(partial(
+        get_redis, url, timeout=config.get('BT_REDIS_REPLICA_TIMEOUT'),
+    ))
+    for url in config.get('REDIS_REPLICA_CONFIGS', ())
+]
+replicas_down = {}
+replica_turns = itertools.count()
+
+
+def live_replicas():
+    """Returns the replicas to try reading from, starting with the next one
+    in turn, leaving out any that couldn't be reached recently.
+    """
+    if not replicas:
+        return []
+
+    start = next(replica_turns) % len(replicas)
+    now = time.time()
+
+    return [
+        replica for replica in replicas[start:] + replicas[:start]
+        if replicas_down.get(replica, 0) <= now
+    ]
+
+
+def pool_exhausted(error):
+    """Returns whether a Redis error is a pool out of free connections.
+
+    The pool raises the same ConnectionError as a failed connection, but
+    while handling its queue coming up empty.
+    """
+    return (
+        isinstance(error, redis.ConnectionError) and
+        isinstance(error.__context__, queue.Empty)
+    )
+
+
+def read(reader):
+    """Returns reader called with a client, a replica if there are any.
+
+    reader must only read. If a replica can't be reached or is too busy to
+    lend a connection it's called again with the next, and finally with the
+    primary. Replicas can lag the primary a little, so reads that need to
+    agree belong in the same reader.
+    """
+    for replica in live_replicas():
+        try:
+            return reader(replica)
+        except (redis.ConnectionError, redis.TimeoutError) as error:
+            if pool_exhausted(error):
+                # Busy rather than down, so it keeps its turn for the next
+                # request
+                metrics.count('bt_redis_replica_busy_total')
+                continue
+
+            logger.warning('Redis replica unreachable, trying the next')
+            metrics.count('bt_redis_replica_failures_total')
+            replicas_down[replica] = (
+                time.time() + config.get('BT_REDIS_REPLICA_RETRY')
+            )
+
+    return reader(r)
@@ -0,0 +1,94 @@
+import json
+import logging
+
+import msgpack
+
+
+logger = logging.getLogger(__name__)
+
+# Stored listings are MessagePack arrays of these fields, after a format
+# version
+FORMAT_VERSION = 1
+FIELDS = (
+    'listing_id',
+    'title',
+    'url',
+    'price',
+    'currency_code',
+    'views',
+    'quantity',
+    'users',
+    'gold',
+    'original_creation_tsz',
+    'image_url',
+    'shop_name',
+    'shop_url',
+)
+
+
+def compact_listing(listing):
+    """Returns only the parts of an API listing the site uses."""
+    images = listing.get('Images') or [{}]
+    shop = listing.get('Shop') or {}
+
+    return {
+        'listing_id': listing.get('listing_id'),
+        'title': listing.get('title'),
+        'url': listing.get('url'),
+        'price': listing.get('price'),
+        'currency_code': listing.get('currency_code'),
+        'views': listing.get('views'),
+        'quantity': listing.get('quantity'),
+        'users': listing.get('users'),
+        'gold': 'gold' in listing.get('materials', []),
+        'original_creation_tsz': listing.get('original_creation_tsz'),
+        'image_url': images[0].get('url_170x135'),
+        'shop_name': shop.get('shop_name'),
+        'shop_url': shop.get('url'),
+    }
+
+
+def encode_listing(listing):
+    """Encodes an API listing for storage."""
+    compact = compact_listing(listing)
+
+    return msgpack.packb([FORMAT_VERSION] + [compact[field] for field in FIELDS])
+
+
+def is_legacy(data):
+    """Returns whether stored data is a whole API listing."""
+    return data[:1] in (b'{', '{')
+
+
+def decode_listing(data):
+    """Decodes a stored listing, whichever format it was stored in.
+
+    Raises ValueError for a format version this code doesn't know the fields
+    of, rather than reading its values into the wrong ones.
+    """
+    if is_legacy(data):
+        return compact_listing(json.loads(data))
+
+    values = msgpack.unpackb(data)
+
+    if values[0] != FORMAT_VERSION:
+        raise ValueError('Unknown listing format version: %r' % values[0])
+
+    return dict(zip(FIELDS, values[1:]))
+
+
+def decode_stored_listing(listing_id, data):
+    """Decodes a stored listing, or returns None if it can't be.
+
+    data is None for listings with nothing stored. Listings in a format
+    version this code doesn't know are logged and skipped, so one of them
+    can't fail a whole page or task.
+    """
+    if data is None:
+        return None
+
+    try:
+        return decode_listing(data)
+    except ValueError as error:
+        logger.warning('Skipping listing %s: %s', listing_id, error)
+        return None
@@ -0,0 +1,191 @@
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+import redis
+
+
+# Metrics are collected in memory by each process and added to these hashes
+# in Redis when flushed, so every prefork worker and web process adds up to
+# one set of numbers. Fields are Prometheus sample names with their labels.
+SAMPLES = 'metrics.samples'
+TYPES = 'metrics.types'
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300,
+)
+
+lock = threading.Lock()
+samples = defaultdict(float)
+types = {}
+last_flush = time.time()
+
+# Redis commands and round trips counted for each task running in this
+# process, innermost last
+task_stack = []
+
+
+def sample_name(name, labels):
+    """Returns a Prometheus sample name with labels."""
+    if not labels:
+        return name
+
+    return '%s{%s}' % (name, ','.join(
+        '%s="%s"' % (key, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        # Histogram buckets keep le last, so they sort together
+        for key, value in sorted(
+            labels.items(), key=lambda label: (label[0] == 'le', label[0]),
+        )
+    ))
+
+
+def count(name, value=1, **labels):
+    """Adds value to a counter."""
+    with lock:
+        types[name] = 'counter'
+        samples[sample_name(name, labels)] += value
+
+
+def observe(name, value, **labels):
+    """Adds an observation to a histogram."""
+    with lock:
+        types[name] = 'histogram'
+
+        for bound in BUCKETS:
+            samples[sample_name(
+                name + '_bucket', dict(labels, le=repr(float(bound))),
+            )] += 1 if value <= bound else 0
+        samples[sample_name(name + '_bucket', dict(labels, le='+Inf'))] += 1
+        samples[sample_name(name + '_sum', labels)] += value
+        samples[sample_name(name + '_count', labels)] += 1
+
+
+@contextmanager
+def timer(name, **labels):
+    """Observes how long the block takes in a histogram."""
+    start = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def start_task(task_name):
+    """Starts timing a task and counting its Redis calls."""
+    task_stack.append({
+        'task': task_name,
+        'start': time.perf_counter(),
+        'commands': 0,
+        'round_trips': 0,
+    })
+
+
+def finish_task(task_name, state):
+    """Records the duration and Redis calls of the innermost task."""
+    if not task_stack:
+        return
+
+    task = task_stack.pop()
+
+    observe(
+        'bt_task_duration_seconds', time.perf_counter() - task['start'],
+        task=task_name, state=state,
+    )
+    count('bt_redis_commands_total', task['commands'], task=task_name)
+    count('bt_redis_round_trips_total', task['round_trips'], task=task_name)
+
+
+def count_redis_calls():
+    """Counts the Redis commands and round trips made by running tasks.
+
+    Commands sent on their own are a round trip each, and a pipeline is one
+    round trip for all the commands in it.
+    """
+    execute_command = redis.Redis.execute_command
+    execute_pipeline = redis.client.Pipeline.execute
+
+    if getattr(execute_command, 'counted', False):
+        return
+
+    def counted_command(self, *args, **options):
+        if task_stack:
+            task_stack[-1]['commands'] += 1
+            task_stack[-1]['round_trips'] += 1
+
+        return execute_command(self, *args, **options)
+
+    def counted_pipeline(self, *args, **options):
+        if task_stack and self.command_stack:
+            task_stack[-1]['commands'] += len(self.command_stack)
+            task_stack[-1]['round_trips'] += 1
+
+        return execute_pipeline(self, *args, **options)
+
+    counted_command.counted = True
+    redis.Redis.execute_command = counted_command
+    redis.client.Pipeline.execute = counted_pipeline
+
+
+def flush(r, interval=0):
+    """Adds the metrics collected since the last flush to Redis.
+
+    Does nothing until interval seconds have passed since the last flush.
+    """
+    global samples, types, last_flush
+
+    with lock:
+        if not samples or time.time() - last_flush < interval:
+            return
+
+        flushing, flushing_types = samples, types
+        samples, types = defaultdict(float), {}
+        last_flush = time.time()
+
+    pipe = r.pipeline(transaction=False)
+    if flushing_types:
+        pipe.hset(TYPES, mapping=flushing_types)
+    for name, value in flushing.items():
+        pipe.hincrbyfloat(SAMPLES, name, value)
+    pipe.execute()
+
+
+def sample_order(line):
+    """Orders a family's samples, with histogram buckets in order."""
+    name = line.rsplit(' ', 1)[0]
+    bucket = name.rfind('le="')
+
+    if bucket == -1:
+        return name, 0
+
+    return name[:bucket], float(name[bucket + 4:name.index('"', bucket + 4)])
+
+
+def render(r):
+    """Returns every process's metrics in the Prometheus text format."""
+    pipe = r.pipeline(transaction=False)
+    pipe.hgetall(TYPES)
+    pipe.hgetall(SAMPLES)
+    metric_types, metric_samples = pipe.execute()
+
+    families = defaultdict(list)
+    for name, value in metric_samples.items():
+        name = name.decode('utf-8')
+        family = name.split('{', 1)[0]
+
+        if family.encode('utf-8') not in metric_types:
+            family = family.rsplit('_', 1)[0]
+
+        families[family].append('%s %s' % (name, float(value)))
+
+    lines = []
+    for family in sorted(families):
+        lines.append('# TYPE %s %s' % (
+            family, metric_types[family.encode('utf-8')].decode('utf-8'),
+        ))
+        lines.extend(sorted(families[family], key=sample_order))
+
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,123 @@
+import hashlib
+import math
+import time
+
+import metrics
+from config import config
+from db import r
+
+
+# Listings known to be inactive or removed are remembered in a Bloom filter,
+# so they can be skipped without tracking users or spending API calls on them.
+# A new filter starts every BT_DEAD_TTL seconds and the last two are checked,
+# so listings are forgotten after one to two periods. Checks are counted in
+# bt_dead_filter_total, labelled hit for dead listings and miss for the rest.
+
+
+def filter_size():
+    """Returns the number of bits and hashes for the configured error rate."""
+    capacity = config.get('BT_DEAD_CAPACITY')
+    error_rate = config.get('BT_DEAD_ERROR_RATE')
+
+    bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    hashes = max(1, round(bits / capacity * math.log(2)))
+
+    return bits, hashes
+
+
+def filter_keys(now=None):
+    """Returns the keys of the current and previous filters."""
+    generation = int((time.time() if now is None else now) //
+                     config.get('BT_DEAD_TTL'))
+
+    return [
+        'listings.dead.%s' % generation,
+        'listings.dead.%s' % (generation - 1),
+    ]
+
+
+def offsets(listing_id, bits, hashes):
+    """Returns the filter bits for a listing, by double hashing."""
+    digest = hashlib.blake2b(str(listing_id).encode('utf-8'), digest_size=16)
+    first = int.from_bytes(digest.digest()[:8], 'little')
+    second = int.from_bytes(digest.digest()[8:], 'little') | 1
+
+    return [(first + i * second) % bits for i in range(hashes)]
+
+
+def add(listing_ids, pipe=None):
+    """Remembers listings as dead.
+
+    The writes are queued on pipe if one is given, otherwise they're sent in
+    a pipeline of their own.
+    """
+    if not listing_ids:
+        return
+
+    bits, hashes = filter_size()
+    key, _ = filter_keys()
+    add_pipe = r.pipeline(transaction=False) if pipe is None else pipe
+
+    for listing_id in listing_ids:
+        command = ['BITFIELD', key]
+        for offset in offsets(listing_id, bits, hashes):
+            command.extend(['SET', 'u1', offset, 1])
+        add_pipe.execute_command(*command)
+
+    add_pipe.expire(key, 2 * config.get('BT_DEAD_TTL'))
+
+    if pipe is None:
+        add_pipe.execute()
+
+
+def filter_live(listing_ids, count=True):
+    """Returns the listings that aren't known to be dead, in order.
+
+    Set count to False when checking listings that were already counted.
+    """
+    if not listing_ids:
+        return []
+
+    bits, hashes = filter_size()
+    keys = filter_keys()
+
+    pipe = r.pipeline(transaction=False)
+    for listing_id in listing_ids:
+        command = []
+        for offset in offsets(listing_id, bits, hashes):
+            command.extend(['GET', 'u1', offset])
+
+        for key in keys:
+            pipe.execute_command('BITFIELD', key, *command)
+
+    results = pipe.execute()
+
+    live = [
+        listing_id for i, listing_id in enumerate(listing_ids)
+        if not any(
+            all(result) for result in results[i * len(keys):(i + 1) * len(keys)]
+        )
+    ]
+
+    if count:
+        metrics.count(
+            'bt_dead_filter_total', len(listing_ids) - len(live), result='hit',
+        )
+        metrics.count('bt_dead_filter_total', len(live), result='miss')
+
+    return live
+
+
+def stats():
+    """Returns how many listings were found dead and alive, as of the last
+    metrics flush.
+    """
+    hits, misses = r.hmget(metrics.SAMPLES, *(
+        metrics.sample_name('bt_dead_filter_total', {'result': result})
+        for result in ('hit', 'miss')
+    ))
+
+    return {
+        'hits': int(float(hits or 0)),
+        'misses': int(float(misses or 0)),
+    }
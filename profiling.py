@@ -0,0 +1,135 @@
+import cProfile
+import os
+import random
+import re
+import threading
+import time
+
+
+# Only one profile runs at a time in a process, since cProfile can't nest and
+# green threads share the profiler of the thread they run on
+lock = threading.Lock()
+active = False
+
+
+def sample(rate):
+    """Starts profiling for a fraction rate of calls.
+
+    Returns the running profile, or None if this call isn't sampled or
+    another profile is already running.
+    """
+    global active
+
+    if random.random() >= rate:
+        return None
+
+    with lock:
+        if active:
+            return None
+        active = True
+
+    profile = cProfile.Profile()
+    profile.enable()
+
+    return profile
+
+
+def save(profile, directory, keep, name, size):
+    """Stops a profile and writes it to directory, keeping the newest keep.
+
+    The file name holds the time, the process, name and size, the number of
+    arguments the profiled call was given.
+    """
+    global active
+
+    profile.disable()
+
+    with lock:
+        active = False
+
+    path = os.path.join(directory, '%d-%s-%s-%sargs.prof' % (
+        time.time() * 1000, os.getpid(), re.sub(r'[^\w.-]+', '_', name), size,
+    ))
+    profile.dump_stats(path)
+
+    profiles = sorted(
+        os.path.join(directory, filename) for filename in os.listdir(directory)
+        if filename.endswith('.prof')
+    )
+    for old in profiles[:-keep]:
+        try:
+            os.remove(old)
+        except OSError:
+            # Another process got to it first
+            pass
+
+
+def profile_requests(app):
+    """Profiles a sample of requests, if BT_PROFILE_RATE is set.
+
+    Nothing is registered otherwise, so requests don't pay for it.
+    """
+    from flask import g, request
+
+    rate = app.config.get('BT_PROFILE_RATE')
+    if not rate:
+        return
+
+    directory = app.config.get('BT_PROFILE_DIR')
+    keep = app.config.get('BT_PROFILE_KEEP')
+    os.makedirs(directory, exist_ok=True)
+
+    @app.before_request
+    def start_request_profile():
+        g.profile = sample(rate)
+
+    @app.teardown_request
+    def save_request_profile(exception=None):
+        profile = g.pop('profile', None)
+
+        if profile is not None:
+            rule = request.url_rule
+            save(
+                profile, directory, keep,
+                'web' + (rule.rule if rule is not None else request.path),
+                len(request.args) + len(request.form),
+            )
+
+
+def profile_tasks(config):
+    """Profiles a sample of Celery tasks, if BT_PROFILE_RATE is set.
+
+    Nothing is connected otherwise, so tasks don't pay for it. Returns the
+    connected prerun and postrun receivers.
+    """
+    from celery.signals import task_postrun, task_prerun
+
+    rate = config.get('BT_PROFILE_RATE')
+    if not rate:
+        return None
+
+    directory = config.get('BT_PROFILE_DIR')
+    keep = config.get('BT_PROFILE_KEEP')
+    os.makedirs(directory, exist_ok=True)
+
+    profiles = {}
+
+    @task_prerun.connect(weak=False)
+    def start_task_profile(task_id=None, **kwargs):
+        profile = sample(rate)
+
+        if profile is not None:
+            profiles[task_id] = profile
+
+    @task_postrun.connect(weak=False)
+    def save_task_profile(task_id=None, task=None, args=(), kwargs=None,
+                          **extra):
+        profile = profiles.pop(task_id, None)
+
+        if profile is not None:
+            save(
+                profile, directory, keep, task.name,
+                len(args or ()) + len(kwargs or {}),
+            )
+
+    return start_task_profile, save_task_profile
@@ -0,0 +1,123 @@
+import logging
+import time
+
+from config import config
+from db import r
+
+
+logger = logging.getLogger(__name__)
+
+BUCKET = 'ratelimit.etsy'
+
+# Reserves a token from the shared bucket, refilling it for the time passed
+# since the last reservation. Returns whether a token was reserved and how
+# many seconds to wait before using it (or before trying again, if the bucket
+# is backing off). Tokens can go negative, which queues callers fairly.
+#
+# KEYS[1] is the bucket. ARGV is the current time, the default refill rate and
+# the bucket size.
+reserve_token = r.register_script("""
+local now = tonumber(ARGV[1])
+local bucket = redis.call(
+    'HMGET', KEYS[1], 'tokens', 'updated', 'rate', 'backoff_until'
+)
+local burst = tonumber(ARGV[3])
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+local rate = tonumber(bucket[3]) or tonumber(ARGV[2])
+local backoff_until = tonumber(bucket[4]) or 0
+
+if now < backoff_until then
+    return {0, tostring(backoff_until - now)}
+end
+
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate) - 1
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+
+if tokens >= 0 then
+    return {1, '0'}
+end
+
+return {1, tostring(-tokens / rate)}
+""")
+
+
+def acquire():
+    """Blocks until this process may make an API call."""
+    while True:
+        reserved, wait = reserve_token(keys=[BUCKET], args=[
+            time.time(),
+            config.get('BT_API_RATE'),
+            config.get('BT_API_BURST'),
+        ])
+        wait = float(wait)
+
+        if wait > 0:
+            time.sleep(wait)
+
+        if reserved:
+            return
+
+
+def available():
+    """Returns roughly how many API calls could be made right now."""
+    tokens, updated, rate, backoff_until = r.hmget(
+        BUCKET, 'tokens', 'updated', 'rate', 'backoff_until',
+    )
+    now = time.time()
+    burst = config.get('BT_API_BURST')
+
+    if backoff_until is not None and now < float(backoff_until):
+        return 0
+
+    if tokens is None:
+        return burst
+
+    rate = config.get('BT_API_RATE') if rate is None else float(rate)
+
+    return min(burst, float(tokens) + max(0, now - float(updated)) * rate)
+
+
+def adapt_rate(remaining):
+    """Returns a refill rate that spreads the remaining quota over the window."""
+    return min(
+        max(remaining / config.get('BT_API_RATE_WINDOW'),
+            config.get('BT_API_MIN_RATE')),
+        config.get('BT_API_MAX_RATE'),
+    )
+
+
+def back_off():
+    """Pauses all API calls, doubling the pause for each failure in a row."""
+    failures = r.hincrby(BUCKET, 'failures', 1)
+
+    delay = min(
+        config.get('BT_API_BACKOFF') * 2 ** (failures - 1),
+        config.get('BT_API_MAX_BACKOFF'),
+    )
+
+    r.hset(BUCKET, 'backoff_until', time.time() + delay)
+
+    return delay
+
+
+def record_response(response):
+    """Updates the shared bucket from an API response."""
+    if response.status_code == 429 or response.status_code >= 500:
+        delay = back_off()
+        logger.warning('Etsy API returned %s, backing off for %.1fs' % (
+            response.status_code, delay,
+        ))
+        return
+
+    update = {'failures': 0}
+
+    rate_limit = response.headers.get('X-RateLimit-Limit')
+    rate_limit_remaining = response.headers.get('X-RateLimit-Remaining')
+    if rate_limit_remaining is not None:
+        update['rate'] = adapt_rate(int(rate_limit_remaining))
+        logger.info('Etsy rate limit: {}/{}, refilling at {:.3f}/s'.format(
+            rate_limit_remaining, rate_limit, update['rate'],
+        ))
+
+    r.hset(BUCKET, mapping=update)
@@ -11,6 +11,30 @@ ETSY_API_SECRET = os.environ.get('ETSY_API_SECRET')
 
 REDIS_CONFIG = urlparse(os.environ.get('REDISCLOUD_URL'))
 
+# Read-only replicas of that Redis, comma separated, for the web tier's reads
+REDIS_REPLICA_CONFIGS = [
+    urlparse(url.strip()) for url in
+    os.environ.get('REDIS_REPLICA_URLS', '').split(',') if url.strip()
+]
+
+# Seconds to wait connecting to Redis, and seconds a replica that couldn't be
+# reached is skipped for
+BT_REDIS_CONNECT_TIMEOUT = float(os.environ.get('BT_REDIS_CONNECT_TIMEOUT', 5))
+BT_REDIS_REPLICA_RETRY = int(os.environ.get('BT_REDIS_REPLICA_RETRY', 30))
+
+# Seconds to wait for a replica to answer before reading from the next one
+BT_REDIS_REPLICA_TIMEOUT = float(os.environ.get('BT_REDIS_REPLICA_TIMEOUT', 2))
+
+# Most connections each process opens to Redis, and seconds to wait for one
+# when they're all in use
+BT_REDIS_MAX_CONNECTIONS = int(os.environ.get('BT_REDIS_MAX_CONNECTIONS', 50))
+BT_REDIS_POOL_TIMEOUT = int(os.environ.get('BT_REDIS_POOL_TIMEOUT', 20))
+
+# Seconds a Redis connection can sit idle before it's checked ahead of use
+BT_REDIS_HEALTH_CHECK_INTERVAL = int(
+    os.environ.get('BT_REDIS_HEALTH_CHECK_INTERVAL', 30)
+)
+
 # These Buried Treasure settings come from the environment, so you know they're
 # good for you.
 
@@ -23,11 +47,122 @@ BT_GOLD_BONUS = int(os.environ.get('BT_GOLD_BONUS', 50))
 # Number of low user count listing ids preserved when scrubbing scrubs
 BT_SCRUB_LIMIT = int(os.environ.get('BT_SCRUB_LIMIT', 5000))
 
+# Number of single-user listings purged per pipeline when scrubbing scrubs
+BT_SCRUB_BATCH = int(os.environ.get('BT_SCRUB_BATCH', 500))
+
+# Etsy API calls per second across all workers until Etsy reports our quota
+BT_API_RATE = float(os.environ.get('BT_API_RATE', 10000 / 86400))
+
+# Etsy API calls that can be made back to back after a quiet spell
+BT_API_BURST = int(os.environ.get('BT_API_BURST', 10))
+
+# Seconds over which the remaining Etsy quota is spread
+BT_API_RATE_WINDOW = int(os.environ.get('BT_API_RATE_WINDOW', 86400))
+
+# Bounds on the adaptive Etsy API call rate, in calls per second
+BT_API_MIN_RATE = float(os.environ.get('BT_API_MIN_RATE', 1 / 60))
+BT_API_MAX_RATE = float(os.environ.get('BT_API_MAX_RATE', 10))
+
+# Seconds all API calls pause after an error, doubling for each error in a row
+BT_API_BACKOFF = float(os.environ.get('BT_API_BACKOFF', 1))
+BT_API_MAX_BACKOFF = float(os.environ.get('BT_API_MAX_BACKOFF', 300))
+
+# Pooled keep-alive connections to the Etsy API per worker process
+BT_HTTP_POOL_SIZE = int(os.environ.get('BT_HTTP_POOL_SIZE', 10))
+
+# Seconds to wait for the Etsy API to accept a connection and to respond
+BT_API_CONNECT_TIMEOUT = float(os.environ.get('BT_API_CONNECT_TIMEOUT', 3.05))
+BT_API_READ_TIMEOUT = float(os.environ.get('BT_API_READ_TIMEOUT', 30))
+
+# Number of times a failed Etsy API call is retried, and the base delay in
+# seconds before a retry, doubling for each attempt with full jitter
+BT_API_RETRIES = int(os.environ.get('BT_API_RETRIES', 3))
+BT_API_RETRY_DELAY = float(os.environ.get('BT_API_RETRY_DELAY', 0.5))
+
+# Number of hashes the first users of single-user listings are spread over.
+# Keep it above the number of tracked listings divided by Redis's
+# hash-max-listpack-entries (128 by default) so the hashes stay compact.
+BT_USER_BUCKETS = int(os.environ.get('BT_USER_BUCKETS', 16384))
+
+# Number of treasuries to get at a time, and the most pages to go back for
+# treasuries created since the last run
+BT_TREASURY_PAGE_SIZE = int(os.environ.get('BT_TREASURY_PAGE_SIZE', 100))
+BT_TREASURY_MAX_PAGES = int(os.environ.get('BT_TREASURY_MAX_PAGES', 10))
+
 # Number of listing records to get at a time
 BT_CHUNK_SIZE = int(os.environ.get('BT_CHUNK_SIZE', 50))
 
+# Number of treasures shown on the index page and kept in the snapshot
+BT_TOP_COUNT = int(os.environ.get('BT_TOP_COUNT', 100))
+
+# Number of rendered index pages cached per web process
+BT_PAGE_CACHE_SIZE = int(os.environ.get('BT_PAGE_CACHE_SIZE', 8))
+
+# Default and largest number of treasures in a page of /api/treasures
+BT_TREASURES_PAGE_SIZE = int(os.environ.get('BT_TREASURES_PAGE_SIZE', 50))
+BT_TREASURES_MAX_PAGE_SIZE = int(
+    os.environ.get('BT_TREASURES_MAX_PAGE_SIZE', 500)
+)
+
+# Seconds clients may reuse a page of /api/treasures without revalidating
+BT_TREASURES_MAX_AGE = int(os.environ.get('BT_TREASURES_MAX_AGE', 60))
+
+# Seconds between keepalive comments on an idle /stream connection
+BT_STREAM_KEEPALIVE = int(os.environ.get('BT_STREAM_KEEPALIVE', 15))
+
+# Rank delta messages a /stream connection can fall behind by before it's
+# dropped
+BT_STREAM_QUEUE_SIZE = int(os.environ.get('BT_STREAM_QUEUE_SIZE', 100))
+
+# Seconds web processes collect metrics for before adding them to Redis
+BT_METRICS_FLUSH_INTERVAL = int(
+    os.environ.get('BT_METRICS_FLUSH_INTERVAL', 10)
+)
+
+# Fraction of web requests and Celery tasks to profile, off by default
+BT_PROFILE_RATE = float(os.environ.get('BT_PROFILE_RATE', 0))
+
+# Directory profiles are written to, and how many of the newest are kept
+BT_PROFILE_DIR = os.environ.get('BT_PROFILE_DIR', '/tmp/buried-treasure')
+BT_PROFILE_KEEP = int(os.environ.get('BT_PROFILE_KEEP', 100))
+
+# Seconds a partial chunk of listings waits to fill up before it's fetched
+BT_BATCH_MAX_WAIT = int(os.environ.get('BT_BATCH_MAX_WAIT', 300))
+
+# Seconds after a listing is fetched before it's worth fetching again, unless
+# it gains users
+BT_FRESH_TIME = int(os.environ.get('BT_FRESH_TIME', 3600))
+
+# Seconds after which a fetch that hasn't finished is assumed lost
+BT_INFLIGHT_TIMEOUT = int(os.environ.get('BT_INFLIGHT_TIMEOUT', 3600))
+
+# Number of top treasures whose data is kept fresh by refresh_treasures
+BT_REFRESH_WINDOW = int(os.environ.get('BT_REFRESH_WINDOW', 200))
+
+# Seconds before the top treasure's data is fetched again, growing to
+# BT_REFRESH_MAX_TTL at the bottom of BT_REFRESH_WINDOW
+BT_REFRESH_MIN_TTL = int(os.environ.get('BT_REFRESH_MIN_TTL', 3600))
+BT_REFRESH_MAX_TTL = int(os.environ.get('BT_REFRESH_MAX_TTL', 60 * 60 * 24))
+
+# Seconds between rescoring every listing as it ages
+BT_RESCORE_INTERVAL = int(os.environ.get('BT_RESCORE_INTERVAL', 3600))
+
+# Number of listings rescored at a time
+BT_RESCORE_CHUNK = int(os.environ.get('BT_RESCORE_CHUNK', 5000))
+
+# Number of dead listings remembered per BT_DEAD_TTL seconds, and the chance
+# of mistaking a live listing for a dead one
+BT_DEAD_CAPACITY = int(os.environ.get('BT_DEAD_CAPACITY', 1000000))
+BT_DEAD_ERROR_RATE = float(os.environ.get('BT_DEAD_ERROR_RATE', 0.01))
+
+# Seconds dead listings are remembered for, give or take the same again
+BT_DEAD_TTL = int(os.environ.get('BT_DEAD_TTL', 60 * 60 * 24 * 7))
+
 # Number of listings to keep data for
 BT_LISTING_LIMIT = int(os.environ.get('BT_LISTING_LIMIT', 500))
 
+# Number of listings dropped at a time when trimming down to the limit
+BT_TRIM_BATCH = int(os.environ.get('BT_TRIM_BATCH', 500))
+
 # The time in days after which age goes from detriment to benefit
 BT_AGE_PIVOT = int(os.environ.get('BT_AGE_PIVOT', 1000))
@@ -0,0 +1,87 @@
+(function() {
+  var $treasures = $('#treasures[data-version]');
+
+  if (!$treasures.length || !window.EventSource) {
+    return;
+  }
+
+  var version = parseInt($treasures.data('version')),
+      source = new EventSource('/stream');
+
+  function oneline(tag, $content) {
+    return $('<p class="oneline"></p>').append($('<' + tag + '></' + tag + '>').append($content));
+  }
+
+  function card(listing) {
+    var $card = $('<li class="span2 thumbnail"></li>')
+      .attr('id', 'listing_' + listing.listing_id)
+      .toggleClass('gold', !!listing.gold);
+
+    $card.append(
+      $('<a onclick="window.open(this.href); return false;"></a>')
+        .attr({href: listing.url, title: listing.title})
+        .append($('<img />').attr({src: listing.image_url, alt: listing.title}))
+        .append(oneline('strong', document.createTextNode(listing.title))),
+      $('<p class="oneline"></p>').append(
+        $('<a onclick="window.open(this.href); return false;"></a>')
+          .attr({href: listing.shop_url, title: listing.shop_name})
+          .text(listing.shop_name)
+      ),
+      $('<p class="oneline"></p>').text(listing.price + ' ' + listing.currency_code),
+      $('<p class="oneline"></p>').append(
+        $('<span title="Quantity"><i class="icon-th"></i> </span>').append(document.createTextNode(listing.quantity)),
+        $('<span class="pull-right" title="Views"><i class="icon-eye-open"></i> </span>').append(document.createTextNode(listing.views))
+      ),
+      $('<p class="oneline"></p>').append(
+        $('<span class="pull-right" title="Users"><i class="icon-user"></i> </span>').append(document.createTextNode(listing.users))
+      )
+    );
+
+    return $card;
+  }
+
+  function place($card, rank) {
+    var $at = $treasures.children().eq(rank);
+
+    if ($at.length) {
+      $card.insertBefore($at);
+    } else {
+      $treasures.append($card);
+    }
+  }
+
+  source.onmessage = function(event) {
+    var message = JSON.parse(event.data);
+
+    // Deltas only apply to the version before them, so start over if any
+    // were missed
+    if (message.version !== version + 1) {
+      source.close();
+      window.location.reload();
+      return;
+    }
+
+    // Take out everything that's leaving or moving first, so the listings
+    // left are in their new order and each rank counts only what's above it
+    var moving = {};
+
+    $.each(message.deltas, function(_, delta) {
+      if (delta.op === 'remove') {
+        $('#listing_' + delta.listing_id).remove();
+      } else if (delta.op === 'move') {
+        moving[delta.listing_id] = $('#listing_' + delta.listing_id).detach();
+      }
+    });
+
+    $.each(message.deltas, function(_, delta) {
+      if (delta.op === 'insert') {
+        $('#listing_' + delta.listing_id).remove();
+        place(card(delta.listing), delta.rank);
+      } else if (delta.op === 'move') {
+        place(moving[delta.listing_id], delta.rank);
+      }
+    });
+
+    version = message.version;
+  };
+})();
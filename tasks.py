@@ -1,13 +1,28 @@
+import bisect
+import itertools
 import json
+import math
+import os
 import random
 import time
+import zlib
 
+import numpy
+import redis
 import requests
 from celery import Celery
+from celery.signals import task_postrun, task_prerun
 from celery.utils.log import get_task_logger
 
 import celeryconfig
-from app import app, r
+import metrics
+import negcache
+import profiling
+import ratelimit
+from config import config
+from db import r
+from listings import decode_stored_listing, encode_listing, is_legacy
+from treasures import DELTAS_CHANNEL, SORT_FIELDS, read_treasures
 
 
 celery = Celery(__name__)
@@ -15,36 +30,165 @@ celery.config_from_object(celeryconfig)
 
 logger = get_task_logger(__name__)
 
+metrics.count_redis_calls()
+profiling.profile_tasks(config)
+
+session = None
+session_pid = None
+
+
+def stage(name):
+    """Times a stage of a task."""
+    return metrics.timer('bt_stage_duration_seconds', stage=name)
+
+
+@task_prerun.connect
+def start_task_metrics(task=None, **kwargs):
+    metrics.start_task(task.name)
+
+
+@task_postrun.connect
+def finish_task_metrics(task=None, state=None, **kwargs):
+    metrics.finish_task(task.name, state)
+    metrics.flush(r)
+
+
+def get_session():
+    """Returns this process's pooled HTTP session.
+
+    Prefork children get a session of their own rather than sharing the
+    parent's sockets.
+    """
+    global session, session_pid
+
+    if session is None or session_pid != os.getpid():
+        adapter = requests.adapters.HTTPAdapter(
+            pool_maxsize=config.get('BT_HTTP_POOL_SIZE'),
+        )
+
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session_pid = os.getpid()
+
+    return session
+
+
+def is_transient(response):
+    """Returns whether a failed response is worth retrying."""
+    return response.status_code == 429 or response.status_code >= 500
+
 
 def api_call(endpoint, **params):
-    params['api_key'] = app.config['ETSY_API_KEY']
-    url = app.config['API_SERVER'] + endpoint
-    response = requests.get(url, params=params)
+    params['api_key'] = config['ETSY_API_KEY']
+    url = config['API_SERVER'] + endpoint
+    timeout = (
+        config.get('BT_API_CONNECT_TIMEOUT'),
+        config.get('BT_API_READ_TIMEOUT'),
+    )
+    retries = config.get('BT_API_RETRIES')
+
+    for attempt in range(retries + 1):
+        ratelimit.acquire()
+
+        start = time.perf_counter()
+        try:
+            response = get_session().get(url, params=params, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            metrics.observe(
+                'bt_api_request_duration_seconds',
+                time.perf_counter() - start,
+                endpoint=endpoint.split('/')[0], status=type(e).__name__,
+            )
 
-    # Log rate limit
-    rate_limit = response.headers.get('X-RateLimit-Limit')
-    rate_limit_remaining = response.headers.get('X-RateLimit-Remaining')
-    if rate_limit is not None:
-        app.logger.info('Etsy rate limit: {}/{}'.format(rate_limit_remaining, rate_limit))
+            if attempt == retries:
+                raise
+
+            logger.warning('API request failed: %s' % e)
+        else:
+            metrics.observe(
+                'bt_api_request_duration_seconds',
+                time.perf_counter() - start,
+                endpoint=endpoint.split('/')[0], status=response.status_code,
+            )
+            ratelimit.record_response(response)
+
+            if attempt == retries or not is_transient(response):
+                break
+
+        time.sleep(random.uniform(
+            0, config.get('BT_API_RETRY_DELAY') * 2 ** attempt,
+        ))
 
     try:
         return response.json()
     except ValueError:
-        app.logger.error('API request failed: %s %s' % (
+        logger.error('API request failed: %s %s' % (
             response.status_code, response.text,
         ))
         raise
 
 
-def get_treasuries():
-    """Returns recent treasury data with listing data."""
-    response = api_call(
-        'treasuries',
-        sort_on='created',
-        fields='user_id,listings',
-    )
+def get_treasuries(mark=None):
+    """Returns treasury data with listing data, newest first.
 
-    return response['results']
+    Pages back until reaching treasuries older than the high-water mark left
+    by treasury_mark, skipping any already seen. Without a mark only the first
+    page is fetched.
+    """
+    page_size = config.get('BT_TREASURY_PAGE_SIZE')
+    max_pages = config.get('BT_TREASURY_MAX_PAGES') if mark else 1
+    seen = set(mark['ids']) if mark else set()
+
+    treasuries = []
+    for page in range(max_pages):
+        results = api_call(
+            'treasuries',
+            sort_on='created',
+            sort_order='down',
+            fields='id,creation_tsz,user_id,listings',
+            limit=page_size,
+            offset=page * page_size,
+        )['results']
+
+        for treasury in results:
+            if mark and treasury['creation_tsz'] < mark['creation_tsz']:
+                return treasuries
+
+            # New treasuries push older ones onto later pages as we go
+            if treasury['id'] not in seen:
+                seen.add(treasury['id'])
+                treasuries.append(treasury)
+
+        if len(results) < page_size:
+            break
+
+    return treasuries
+
+
+def treasury_mark(treasuries, mark=None):
+    """Returns the high-water mark after processing treasuries.
+
+    The mark holds the newest creation time seen and the ids of treasuries
+    created at that time, since several can share a timestamp.
+    """
+    if mark is not None:
+        mark = {'creation_tsz': mark['creation_tsz'], 'ids': list(mark['ids'])}
+
+    for treasury in treasuries:
+        if 'creation_tsz' not in treasury:
+            continue
+
+        if mark is None or treasury['creation_tsz'] > mark['creation_tsz']:
+            mark = {'creation_tsz': treasury['creation_tsz'], 'ids': []}
+
+        if (
+            treasury['creation_tsz'] == mark['creation_tsz'] and
+            treasury['id'] not in mark['ids']
+        ):
+            mark['ids'].append(treasury['id'])
+
+    return mark
 
 
 def unique_users(treasuries):
@@ -72,11 +216,40 @@ def get_listing_data(*listing_ids):
     return response['results']
 
 
-def purge_data(listing_id):
-    """Purges all data for listing listing_id."""
-    r.delete('listings.%s.data' % listing_id)
-    r.delete('listings.%s.users' % listing_id)
-    r.zrem('treasures', listing_id)
+def first_user_key(listing_id):
+    """Returns the key of the hash holding a single-user listing's user.
+
+    Listings are spread over BT_USER_BUCKETS small hashes, which Redis stores
+    far more compactly than a set per listing.
+    """
+    bucket = zlib.crc32(str(listing_id).encode('utf-8')) % (
+        config.get('BT_USER_BUCKETS')
+    )
+
+    return 'listings.first.%s' % bucket
+
+
+def purge_data(listing_id, pipe=None):
+    """Purges all data for listing listing_id.
+
+    The deletes are queued on pipe if one is given, otherwise they're sent
+    in a pipeline of their own.
+    """
+    purge_pipe = r.pipeline() if pipe is None else pipe
+
+    purge_pipe.delete(
+        'listings.%s.data' % listing_id,
+        'listings.%s.users' % listing_id,
+    )
+    purge_pipe.zrem('treasures', listing_id)
+    for field in SORT_FIELDS:
+        purge_pipe.zrem('treasures.%s' % field, listing_id)
+    purge_pipe.hdel(first_user_key(listing_id), listing_id)
+    purge_pipe.zrem('listings.single', listing_id)
+    purge_pipe.zrem('listings.fetched', listing_id)
+
+    if pipe is None:
+        purge_pipe.execute()
 
 
 def listing_is_active(listing):
@@ -88,114 +261,805 @@ def listing_is_active(listing):
     )
 
 
-def save_listing(listing):
-    """Save a listing."""
-    r.set(
+def save_listing(listing, pipe=None):
+    """Save a listing, queueing the write on pipe if one is given."""
+    (r if pipe is None else pipe).set(
         'listings.%s.data' % listing['listing_id'],
-        json.dumps(listing),
+        encode_listing(listing),
     )
 
 
-def score_listing(listing):
-    """Calculate and save a listing's score."""
-    user_weight = app.config.get('BT_USER_WEIGHT')
-    gold_bonus = app.config.get('BT_GOLD_BONUS')
-    age_pivot = app.config.get('BT_AGE_PIVOT')
+def calculate_scores(users, gold, views, quantity, created, now):
+    """Calculates scores from listing attributes.
+
+    Works on single values as well as NumPy arrays of them, so a single
+    listing and a whole batch are scored with the same formula.
+    """
+    user_weight = config.get('BT_USER_WEIGHT')
+    gold_bonus = config.get('BT_GOLD_BONUS')
+    age_pivot = config.get('BT_AGE_PIVOT')
 
     # Age is expressed in days
-    age = (
-        time.time() - float(listing['original_creation_tsz'])
-    ) / (
+    age = (now - created) / (
         60 * 60 * 24  # One day in seconds
     )
 
-    score = (
-        (listing['users'] + (gold_bonus if 'gold' in listing['materials'] else 0))
+    return (
+        (users + gold * gold_bonus)
         * user_weight
         * abs(1 - (age / age_pivot))
     ) / (
-        float(listing['views'])
-        * float(listing['quantity'])
-        + 1
+        views * quantity + 1
     )
 
-    r.zadd('treasures', {listing['listing_id']: score})
 
+def score_listing(listing, pipe=None):
+    """Calculate and save a listing's score.
 
-def process_listings(*listing_ids):
-    """Schedule processing for chunks of listings."""
-    chunk_size = app.config.get('BT_CHUNK_SIZE', 50)
+    The write is queued on pipe if one is given.
+    """
+    score = calculate_scores(
+        listing['users'],
+        'gold' in listing['materials'],
+        float(listing['views']),
+        float(listing['quantity']),
+        float(listing['original_creation_tsz']),
+        time.time(),
+    )
 
-    for i in range(0, len(listing_ids), chunk_size):
-        fetch_detail.delay(
-            *listing_ids[i: i + chunk_size]
-        )
+    (r if pipe is None else pipe).zadd(
+        'treasures', {listing['listing_id']: score},
+    )
+
+
+def index_listing(listing, pipe=None):
+    """Adds a listing to the sorted set for each of SORT_FIELDS.
+
+    The writes are queued on pipe if one is given.
+    """
+    index_pipe = r if pipe is None else pipe
+
+    for field in SORT_FIELDS:
+        index_pipe.zadd('treasures.%s' % field, {
+            listing['listing_id']: float(listing[field]),
+        })
+
+
+def store_listings(data, requested=()):
+    """Saves and scores active listings and purges the rest.
+
+    The requested listing ids are no longer in flight, whether or not they
+    came back in data. User counts are read in one pipeline and everything is
+    written in a second, so a whole chunk costs two round trips however big
+    it is.
+    """
+    active = [listing for listing in data if listing_is_active(listing)]
+    now = time.time()
+
+    count_pipe = r.pipeline(transaction=False)
+    for listing in active:
+        count_pipe.scard('listings.%s.users' % listing['listing_id'])
+
+    pipe = r.pipeline()
+    for listing, users in zip(active, count_pipe.execute()):
+        listing['users'] = users
+        save_listing(listing, pipe)
+        score_listing(listing, pipe)
+        index_listing(listing, pipe)
+        pipe.zadd('listings.fetched', {listing['listing_id']: now})
+
+    inactive = [
+        listing['listing_id'] for listing in data
+        if not listing_is_active(listing)
+    ]
+    for listing_id in inactive:
+        purge_data(listing_id, pipe)
+    negcache.add(inactive, pipe)
+
+    if requested:
+        pipe.zrem('listings.inflight', *requested)
+
+    pipe.execute()
+
+    metrics.count('bt_listings_total', len(active), outcome='scored')
+    metrics.count('bt_listings_total', len(inactive), outcome='purged')
+
+
+def rank_deltas(previous, treasures):
+    """Returns the changes that turn one ranking of treasures into another.
+
+    Listings that left are removed and new ones inserted with their data.
+    Of the rest, only listings out of order with the others are moved, so a
+    listing climbing a place doesn't move everything below it. Taking out
+    the removed and moved listings, then placing the inserts and moves in
+    order of rank, gives the new ranking.
+    """
+    previous_ranks = {
+        treasure['listing_id']: rank for rank, treasure in enumerate(previous)
+    }
+    current = set(treasure['listing_id'] for treasure in treasures)
+
+    deltas = [
+        {'op': 'remove', 'listing_id': listing_id}
+        for listing_id in previous_ranks if listing_id not in current
+    ]
+
+    # The longest run of kept listings still in their old order stays put
+    kept = [
+        treasure['listing_id'] for treasure in treasures
+        if treasure['listing_id'] in previous_ranks
+    ]
+    tails = []
+    tail_indexes = []
+    parents = []
+    for i, listing_id in enumerate(kept):
+        position = bisect.bisect_left(tails, previous_ranks[listing_id])
+        if position == len(tails):
+            tails.append(previous_ranks[listing_id])
+            tail_indexes.append(i)
+        else:
+            tails[position] = previous_ranks[listing_id]
+            tail_indexes[position] = i
+        parents.append(tail_indexes[position - 1] if position else None)
+
+    staying = set()
+    i = tail_indexes[-1] if tail_indexes else None
+    while i is not None:
+        staying.add(kept[i])
+        i = parents[i]
+
+    for rank, treasure in enumerate(treasures):
+        listing_id = treasure['listing_id']
+
+        if listing_id not in previous_ranks:
+            deltas.append({
+                'op': 'insert',
+                'listing_id': listing_id,
+                'rank': rank,
+                'score': treasure['score'],
+                'listing': treasure,
+            })
+        elif listing_id not in staying:
+            deltas.append({
+                'op': 'move',
+                'listing_id': listing_id,
+                'rank': rank,
+                'score': treasure['score'],
+            })
+
+    return deltas
+
+
+def update_snapshot():
+    """Rebuilds the pre-serialized snapshot of the top treasures.
+
+    The snapshot and the ranking version are written together, so readers
+    never see a version that doesn't match the snapshot. The rank deltas
+    from the previous snapshot are published on DELTAS_CHANNEL in the same
+    transaction, with the version they lead to.
+    """
+    with r.pipeline() as pipe:
+        while True:
+            try:
+                pipe.watch('treasures.snapshot', 'treasures.version')
+
+                treasures = read_treasures(config.get('BT_TOP_COUNT', 100))
+                previous, version = pipe.mget(
+                    'treasures.snapshot', 'treasures.version',
+                )
+                deltas = rank_deltas(
+                    json.loads(previous) if previous is not None else [],
+                    treasures,
+                )
+
+                pipe.multi()
+                pipe.set('treasures.snapshot', json.dumps(treasures))
+                pipe.incr('treasures.version')
+                pipe.set('treasures.updated', time.time())
+                pipe.publish(DELTAS_CHANNEL, json.dumps({
+                    'version': int(version or 0) + 1,
+                    'deltas': deltas,
+                }))
+                pipe.execute()
+                break
+            except redis.WatchError:
+                # Another worker got there first, so diff against theirs
+                continue
+
+
+# Adds users to each listing in a single call, keeping the single-user index
+# up to date. Returns the position, user count and number of new users of
+# each listing shared by more than one user.
+#
+# A listing's first user is kept in a hash shared with other listings, and
+# only moved into a set of its own once a second user shows up.
+#
+# KEYS[1] is the single-user index, followed by each listing's user set and
+# first user hash in turn. ARGV[1] is the current time, followed by each
+# listing's id, user count and user ids in turn.
+track_users = r.register_script("""
+local shared = {}
+local arg = 2
+
+for i = 2, #KEYS, 2 do
+    local users_key, first_key = KEYS[i], KEYS[i + 1]
+    local listing_id = ARGV[arg]
+    local count = tonumber(ARGV[arg + 1])
+    local new_users = {unpack(ARGV, arg + 2, arg + 1 + count)}
+    arg = arg + 2 + count
+
+    local users, added
+    if redis.call('EXISTS', users_key) == 1 then
+        added = redis.call('SADD', users_key, unpack(new_users))
+        users = redis.call('SCARD', users_key)
+    else
+        local first = redis.call('HGET', first_key, listing_id)
+
+        local distinct = {}
+        local seen = {}
+        if first then
+            table.insert(distinct, first)
+            seen[first] = true
+        end
+        for _, user in ipairs(new_users) do
+            if not seen[user] then
+                table.insert(distinct, user)
+                seen[user] = true
+            end
+        end
+
+        users = #distinct
+        added = first and users - 1 or users
+
+        if users > 1 then
+            redis.call('SADD', users_key, unpack(distinct))
+            redis.call('HDEL', first_key, listing_id)
+        elseif not first then
+            redis.call('HSET', first_key, listing_id, distinct[1])
+        end
+    end
+
+    if users > 1 then
+        redis.call('ZREM', KEYS[1], listing_id)
+        table.insert(shared, {(i - 2) / 2, users, added})
+    else
+        -- Index single-user listings by when they were first seen
+        redis.call('ZADD', KEYS[1], 'NX', ARGV[1], listing_id)
+    end
+end
+
+return shared
+""")
+
+
+def listing_priority(users, fetched, rank, now):
+    """Estimates how much fetching a listing could change the visible ranking.
+
+    Listings with more users, older data and a place on the index page are
+    worth more.
+    """
+    day = 60 * 60 * 24
+
+    staleness = 1 if fetched is None else min(now - fetched, day) / day
+    visible = rank is not None and rank < config.get('BT_TOP_COUNT', 100)
+
+    return users * (1 + staleness) * (2 if visible else 1)
+
+
+def process_listings(*listing_ids, changed=()):
+    """Queue listings for processing by priority.
+
+    Listings known to be dead are skipped, as are listings fetched within
+    BT_FRESH_TIME or already being fetched unless they're in changed. Queued
+    listings wait in a shared buffer, so ids from several fetch_listings runs
+    are combined and each one is only queued once.
+    """
+    fresh_time = config.get('BT_FRESH_TIME')
+    inflight_timeout = config.get('BT_INFLIGHT_TIMEOUT')
+    changed = set(changed)
+
+    # fetch_listings has already counted these in the filter's metrics
+    listing_ids = negcache.filter_live(listing_ids, count=False)
+
+    pipe = r.pipeline(transaction=False)
+    for listing_id in listing_ids:
+        pipe.zscore('listings.fetched', listing_id)
+        pipe.zscore('listings.inflight', listing_id)
+        pipe.scard('listings.%s.users' % listing_id)
+        pipe.zrevrank('treasures', listing_id)
+    results = pipe.execute()
+
+    now = time.time()
+    priorities = {}
+    for listing_id, fetched, inflight, users, rank in zip(
+        listing_ids, results[::4], results[1::4], results[2::4], results[3::4],
+    ):
+        if listing_id not in changed and (
+            (fetched is not None and now - fetched < fresh_time) or
+            (inflight is not None and now - inflight < inflight_timeout)
+        ):
+            continue
+
+        priorities[listing_id] = listing_priority(users, fetched, rank, now)
+
+    queue_pending(priorities)
+
+
+def queue_pending(priorities):
+    """Adds listings to the shared buffer with the given priorities."""
+    if priorities:
+        pipe = r.pipeline()
+        pipe.zadd('listings.pending', priorities)
+        pipe.set('listings.pending.since', time.time(), nx=True)
+        pipe.execute()
+
+    flush_pending()
+
+
+def flush_pending():
+    """Schedule processing for the highest priority buffered listings.
+
+    Chunks are only sent while the API budget allows, leaving the rest in the
+    buffer where more valuable listings can overtake them. A partial chunk is
+    only sent once the buffer has waited for BT_BATCH_MAX_WAIT seconds.
+    """
+    chunk_size = config.get('BT_CHUNK_SIZE', 50)
+    max_wait = config.get('BT_BATCH_MAX_WAIT')
+
+    # Chunks already sent will spend some of the budget when they run
+    inflight = r.zcard('listings.inflight')
+    budget = int(ratelimit.available()) - math.ceil(inflight / chunk_size)
+
+    while budget > 0:
+        pipe = r.pipeline(transaction=False)
+        pipe.zcard('listings.pending')
+        pipe.get('listings.pending.since')
+        pending, since = pipe.execute()
+
+        if not pending:
+            break
+
+        if pending < chunk_size and (
+            since is None or time.time() - float(since) < max_wait
+        ):
+            break
+
+        chunk = [
+            listing_id.decode('utf-8') for listing_id, _ in
+            r.zpopmax('listings.pending', chunk_size)
+        ]
+
+        if pending <= chunk_size:
+            r.delete('listings.pending.since')
+
+        if chunk:
+            now = time.time()
+            r.zadd('listings.inflight', {
+                listing_id: now for listing_id in chunk
+            })
+            fetch_detail.delay(*chunk)
+            budget -= 1
 
 
 @celery.task
-def fetch_listings():
-    """Fetches and stores listing scores and user ids."""
-    treasuries = get_treasuries()
-    user_map = unique_users(treasuries)
+def flush_listings():
+    """Sends buffered listings that have waited long enough."""
+    # Forget fetches that never finished, so the listings can be queued again
+    r.zremrangebyscore(
+        'listings.inflight',
+        '-inf', time.time() - config.get('BT_INFLIGHT_TIMEOUT'),
+    )
 
-    users_pipe = r.pipeline()
-    score_pipe = r.pipeline()
-    for listing_id in user_map.keys():
-        users_pipe.smembers('listings.%s.users' % listing_id)
-        score_pipe.zscore('treasures', listing_id)
+    flush_pending()
 
-    users_list = users_pipe.execute()
-    score_list = score_pipe.execute()
 
-    combined_data = zip(user_map.keys(), users_list, score_list)
+def refresh_ttl(rank):
+    """Returns how many seconds a listing's data stays fresh at a rank.
 
-    update_pipe = r.pipeline()
+    The TTL grows geometrically from BT_REFRESH_MIN_TTL at the top of the
+    ranking to BT_REFRESH_MAX_TTL at the bottom of BT_REFRESH_WINDOW.
+    """
+    min_ttl = config.get('BT_REFRESH_MIN_TTL')
+    max_ttl = config.get('BT_REFRESH_MAX_TTL')
+    window = config.get('BT_REFRESH_WINDOW')
 
-    process_ids = []
-    for listing_id, existing_users, score in combined_data:
+    return min_ttl * (max_ttl / min_ttl) ** (rank / max(window - 1, 1))
+
+
+@celery.task
+def refresh_treasures():
+    """Queues stale listings near the top of the ranking to be fetched again.
+
+    Listings are otherwise only fetched when they turn up in new treasuries,
+    so a visible listing can keep a stale score long after it sells out or
+    gains views. Only the top BT_REFRESH_WINDOW listings are refreshed, more
+    often the higher they rank, so API calls go where they show.
+    """
+    inflight_timeout = config.get('BT_INFLIGHT_TIMEOUT')
+
+    listing_ids = [
+        listing_id.decode('utf-8') for listing_id in
+        r.zrevrange('treasures', 0, config.get('BT_REFRESH_WINDOW') - 1)
+    ]
+
+    pipe = r.pipeline(transaction=False)
+    for listing_id in listing_ids:
+        pipe.zscore('listings.fetched', listing_id)
+        pipe.zscore('listings.inflight', listing_id)
+        pipe.scard('listings.%s.users' % listing_id)
+    results = pipe.execute()
+
+    now = time.time()
+    priorities = {}
+    for rank, (listing_id, fetched, inflight, users) in enumerate(zip(
+        listing_ids, results[::3], results[1::3], results[2::3],
+    )):
+        if inflight is not None and now - inflight < inflight_timeout:
+            continue
+
+        if fetched is not None and now - fetched < refresh_ttl(rank):
+            continue
+
+        priorities[listing_id] = listing_priority(users, fetched, rank, now)
+
+    queue_pending(priorities)
+
+
+@celery.task
+def fetch_listings():
+    """Fetches and stores user ids for listings in new treasuries."""
+    mark = r.get('treasuries.mark')
+    mark = json.loads(mark) if mark is not None else None
+
+    with stage('get_treasuries'):
+        treasuries = get_treasuries(mark)
+    user_map = unique_users(treasuries)
+
+    # Don't track users for listings that are known to be gone
+    listing_ids = negcache.filter_live(list(user_map.keys()))
+
+    keys = ['listings.single']
+    args = [time.time()]
+    for listing_id in listing_ids:
         users = user_map[listing_id]
-        all_users = users.union([uid.decode('utf-8') for uid in existing_users])
+        keys.append('listings.%s.users' % listing_id)
+        keys.append(first_user_key(listing_id))
+        args.extend([listing_id, len(users)])
+        args.extend(users)
 
-        if len(all_users) > 1:
-            logger.debug(
-                'Found %s users for %s: %r' %
-                (len(all_users), listing_id, all_users),
-            )
+    with stage('track_users'):
+        tracked = track_users(keys=keys, args=args)
 
-            process_ids.append(listing_id)
+    process_ids = []
+    changed_ids = []
+    for position, user_count, added in tracked:
+        listing_id = listing_ids[position]
+        logger.debug('Found %s users for %s' % (user_count, listing_id))
 
-        update_pipe.sadd('listings.%s.users' % listing_id, *users)
+        process_ids.append(listing_id)
 
-    update_pipe.execute()
+        # New users change the score, so it's worth fetching again
+        if added:
+            changed_ids.append(listing_id)
 
-    process_listings(*process_ids)
+    with stage('process_listings'):
+        process_listings(*process_ids, changed=changed_ids)
+
+    mark = treasury_mark(treasuries, mark)
+    if mark is not None:
+        r.set('treasuries.mark', json.dumps(mark))
 
 
 @celery.task
 def scrub_scrubs():
-    """Randomly culls single-user lists."""
-    scrub_limit = app.config.get('BT_SCRUB_LIMIT')
+    """Culls the oldest single-user listings."""
+    scrub_limit = config.get('BT_SCRUB_LIMIT')
+    batch_size = config.get('BT_SCRUB_BATCH', 500)
+
+    # Preserve at least BT_SCRUB_LIMIT, scrubbing half the remainder
+    scrub_count = int(max(r.zcard('listings.single') - scrub_limit, 0)/2)
+
+    while scrub_count > 0:
+        listing_ids = [
+            listing_id.decode('utf-8') for listing_id in
+            r.zrange('listings.single', 0, min(batch_size, scrub_count) - 1)
+        ]
+
+        if not listing_ids:
+            break
+
+        count_pipe = r.pipeline(transaction=False)
+        for listing_id in listing_ids:
+            count_pipe.scard('listings.%s.users' % listing_id)
+
+        purge_pipe = r.pipeline()
+        scrubbed = 0
+        for listing_id, count in zip(listing_ids, count_pipe.execute()):
+            # Another user may have shown up since the listing was indexed
+            if count < 2:
+                purge_data(listing_id, purge_pipe)
+                scrubbed += 1
+            else:
+                purge_pipe.zrem('listings.single', listing_id)
+        purge_pipe.execute()
+
+        metrics.count('bt_listings_total', scrubbed, outcome='scrubbed')
+
+        scrub_count -= len(listing_ids)
+
+
+def batches(iterable, size):
+    """Yields lists of up to size items from iterable, reading it lazily.
+
+    The tasks that walk every key or listing feed a SCAN or ZSCAN through
+    this, so each batch is handled in a few round trips before the next is
+    read, and Redis is never blocked for long.
+    """
+    iterator = iter(iterable)
+
+    while True:
+        batch = list(itertools.islice(iterator, size))
+
+        if not batch:
+            return
+
+        yield batch
+
+
+# Moves each single-user set into its listing's first user hash and indexes
+# the listing, unless another user has shown up since it was read.
+#
+# KEYS[1] is the single-user index, followed by each listing's user set and
+# first user hash in turn. ARGV[1] is the current time, followed by the
+# listings' ids.
+move_single_users = r.register_script("""
+for i = 2, #KEYS, 2 do
+    local listing_id = ARGV[i / 2 + 1]
 
-    users_keys = r.keys('listings.*.users')
+    if redis.call('SCARD', KEYS[i]) == 1 then
+        redis.call('HSETNX', KEYS[i + 1], listing_id, redis.call('SPOP', KEYS[i]))
+        redis.call('ZADD', KEYS[1], 'NX', ARGV[1], listing_id)
+    end
+end
+""")
 
-    # Preserve at least 5000, scrubbing half the remainder
-    scrub_count = int(max(len(users_keys) - scrub_limit, 0)/2)
 
-    for key in random.sample(users_keys, scrub_count):
-        if r.scard(key) < 2:
+@celery.task
+def index_single_users():
+    """Moves single-user listings stored as sets into the compact store."""
+    batch_size = config.get('BT_SCRUB_BATCH', 500)
+
+    for batch in batches(
+        r.scan_iter(match='listings.*.users', count=batch_size), batch_size,
+    ):
+        script_keys = ['listings.single']
+        script_args = [time.time()]
+        for key in batch:
             _, listing_id, _ = key.decode('utf-8').split('.')
-            purge_data(listing_id)
+            script_keys.extend([key, first_user_key(listing_id)])
+            script_args.append(listing_id)
+
+        move_single_users(keys=script_keys, args=script_args)
+
+
+def score_params():
+    """Returns the settings that scores depend on."""
+    return json.dumps([
+        config.get('BT_USER_WEIGHT'),
+        config.get('BT_GOLD_BONUS'),
+        config.get('BT_AGE_PIVOT'),
+    ])
+
+
+def rescore_chunk(listing_ids):
+    """Rescores a chunk of listings from their stored data."""
+    data_pipe = r.pipeline(transaction=False)
+    for listing_id in listing_ids:
+        data_pipe.get('listings.%s.data' % listing_id.decode('utf-8'))
+
+    stored = [
+        (listing_id, listing) for listing_id, listing in (
+            (listing_id, decode_stored_listing(listing_id, data))
+            for listing_id, data in zip(listing_ids, data_pipe.execute())
+        )
+        if listing is not None
+    ]
+
+    if not stored:
+        return
+
+    scores = calculate_scores(
+        numpy.fromiter((d['users'] for _, d in stored), float, len(stored)),
+        numpy.fromiter((d['gold'] for _, d in stored), float, len(stored)),
+        numpy.fromiter((d['views'] for _, d in stored), float, len(stored)),
+        numpy.fromiter((d['quantity'] for _, d in stored), float, len(stored)),
+        numpy.fromiter(
+            (d['original_creation_tsz'] for _, d in stored), float, len(stored),
+        ),
+        time.time(),
+    )
+
+    # Only update scores, so listings purged meanwhile stay purged
+    r.zadd('treasures', {
+        listing_id: float(score)
+        for (listing_id, _), score in zip(stored, scores)
+    }, xx=True)
+
+
+@celery.task
+def rescore_treasures():
+    """Rescores every stored listing without calling the API.
+
+    Scores include the listing's age, so they go stale over time. Everything
+    is rescored every BT_RESCORE_INTERVAL seconds, or straight away when the
+    scoring settings change.
+    """
+    chunk_size = config.get('BT_RESCORE_CHUNK')
+    params = score_params()
+
+    last_params, last_rescored = r.mget('treasures.params', 'treasures.rescored')
+    if (
+        last_params is not None and last_params.decode('utf-8') == params and
+        time.time() - float(last_rescored) < config.get('BT_RESCORE_INTERVAL')
+    ):
+        return
+
+    # ZSCAN returns every listing present throughout, even as scores change
+    for chunk in batches(
+        (listing_id for listing_id, _ in
+         r.zscan_iter('treasures', count=chunk_size)),
+        chunk_size,
+    ):
+        rescore_chunk(chunk)
+
+    r.mset({'treasures.params': params, 'treasures.rescored': time.time()})
+
+    update_snapshot()
+
+
+# Rewrites each key in KEYS with the matching ARGV, unless it has been stored
+# in the compact format since it was read.
+rewrite_legacy = r.register_script("""
+for i, key in ipairs(KEYS) do
+    local data = redis.call('GET', key)
+    if data and string.sub(data, 1, 1) == '{' then
+        redis.call('SET', key, ARGV[i])
+    end
+end
+""")
+
+
+@celery.task
+def migrate_listing_data():
+    """Rewrites listing data stored as whole API listings compactly."""
+    batch_size = config.get('BT_RESCORE_CHUNK')
+
+    for batch in batches(
+        r.scan_iter(match='listings.*.data', count=batch_size), batch_size,
+    ):
+        data_pipe = r.pipeline(transaction=False)
+        for key in batch:
+            data_pipe.get(key)
+
+        legacy = [
+            (key, data) for key, data in zip(batch, data_pipe.execute())
+            if data is not None and is_legacy(data)
+        ]
+
+        if legacy:
+            rewrite_legacy(
+                keys=[key for key, _ in legacy],
+                args=[encode_listing(json.loads(data)) for _, data in legacy],
+            )
+
+    update_snapshot()
+
+
+# Adds listings to the sort indexes, unless they have been purged or trimmed
+# since they were read.
+#
+# KEYS[1] is treasures, followed by the index for each sort field. ARGV is
+# each listing id followed by its value for each sort field.
+index_scored = r.register_script("""
+local fields = #KEYS - 1
+for i = 1, #ARGV, fields + 1 do
+    if redis.call('ZSCORE', KEYS[1], ARGV[i]) then
+        for j = 1, fields do
+            redis.call('ZADD', KEYS[j + 1], ARGV[i + j], ARGV[i])
+        end
+    end
+end
+""")
+
+
+@celery.task
+def index_treasures():
+    """Builds the sort indexes from stored listing data."""
+    chunk_size = config.get('BT_RESCORE_CHUNK')
+
+    for chunk in batches(
+        (listing_id for listing_id, _ in
+         r.zscan_iter('treasures', count=chunk_size)),
+        chunk_size,
+    ):
+        data_pipe = r.pipeline(transaction=False)
+        for listing_id in chunk:
+            data_pipe.get(b'listings.%s.data' % listing_id)
+
+        script_args = []
+        for listing_id, data in zip(chunk, data_pipe.execute()):
+            listing = decode_stored_listing(listing_id, data)
+            if listing is None:
+                continue
+
+            script_args.append(listing_id)
+            script_args.extend(
+                float(listing[field] or 0) for field in SORT_FIELDS
+            )
+
+        if script_args:
+            index_scored(keys=['treasures'] + [
+                'treasures.%s' % field for field in SORT_FIELDS
+            ], args=script_args)
+
+    update_snapshot()
+
+
+@celery.task
+def trim_treasures():
+    """Drops data for the lowest scored listings beyond BT_LISTING_LIMIT.
+
+    Listings are dropped BT_TRIM_BATCH at a time, each batch in its own
+    transaction so scores and data never disagree. Unlike purge_data, user
+    sets are kept so a trimmed listing can climb back in with new users.
+    """
+    limit = config.get('BT_LISTING_LIMIT')
+    batch_size = config.get('BT_TRIM_BATCH')
+    trimmed = False
+
+    while True:
+        with r.pipeline() as pipe:
+            try:
+                pipe.watch('treasures')
+
+                excess = pipe.zcard('treasures') - limit
+                if excess <= 0:
+                    break
+
+                listing_ids = [
+                    listing_id.decode('utf-8') for listing_id in
+                    pipe.zrange('treasures', 0, min(excess, batch_size) - 1)
+                ]
+
+                pipe.multi()
+                pipe.zremrangebyrank('treasures', 0, len(listing_ids) - 1)
+                for field in SORT_FIELDS:
+                    pipe.zrem('treasures.%s' % field, *listing_ids)
+                pipe.delete(*[
+                    'listings.%s.data' % listing_id for listing_id in listing_ids
+                ])
+                pipe.zrem('listings.fetched', *listing_ids)
+                pipe.execute()
+                trimmed = True
+            except redis.WatchError:
+                # Scores changed underneath us, so find the lowest again
+                continue
+
+    # Deep pages of the ranking changed, so move the version on
+    if trimmed:
+        update_snapshot()
 
 
 @celery.task
 def fetch_detail(*listing_ids):
     """Fetches and stores detailed listing data."""
-    data = get_listing_data(*listing_ids)
+    with stage('get_listing_data'):
+        data = get_listing_data(*listing_ids)
 
-    for listing in data:
-        if listing_is_active(listing):
-            listing['users'] = r.scard('listings.%s.users' % listing['listing_id'])
-            save_listing(listing)
-            score_listing(listing)
-        else:
-            purge_data(listing['listing_id'])
+    with stage('store_listings'):
+        store_listings(data, listing_ids)
+
+    # Rebuild once per chunk rather than once per listing
+    if data:
+        with stage('update_snapshot'):
+            update_snapshot()
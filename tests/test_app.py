@@ -1,11 +1,36 @@
 """
 Tests for the Buried Treasure Flask app.
 """
+import gzip
 import json
+from unittest.mock import patch
 
 from bs4 import BeautifulSoup
+import msgpack
+import redis
 
-from app import app, r
+from app import app, r, page_cache, broadcast, get_page, stream_queues
+from config import config
+from listings import FORMAT_VERSION, compact_listing, encode_listing
+
+
+def fake_treasure(listing_id):
+    """Some fake listing data!"""
+    return {
+        'listing_id': listing_id,
+        'quantity': listing_id,
+        'materials': [],
+        'views': listing_id,
+        'url': 'http://google.com',
+        'title': 'HEllo',
+        'Images': [
+            {'url_170x135': 'http://google.com'},
+        ],
+        'price': 123,
+        'currency_code': 'USD',
+        'Shop': {'shop_name': 'Heollo', 'url': 'http://google.com'},
+        'users': 10,
+    }
 
 
 class TestIndex(object):
@@ -14,23 +39,15 @@ class TestIndex(object):
         app.testing = True
         self.client = app.test_client()
 
+        r.flushdb()
+        page_cache.clear()
+
         for i in range(1000):
             r.zadd('treasures', {i: i})
-            r.set('listings.%s.data' % i, json.dumps({
-                'listing_id': i,
-                'quantity': i,
-                'materials': [],
-                'views': i,
-                'url': 'http://google.com',
-                'title': 'HEllo',
-                'Images': [
-                    {'url_170x135': 'http://google.com'},
-                ],
-                'price': 123,
-                'currency_code': 'USD',
-                'Shop': {'shop_name': 'Heollo', 'url': 'http://google.com'},
-                'users': 10,
-            }))
+            r.set('listings.%s.data' % i, json.dumps(fake_treasure(i)))
+
+    def teardown_method(self, method):
+        r.flushdb()
 
     def test_get_response(self):
         """Should return a response."""
@@ -54,3 +71,484 @@ class TestIndex(object):
         document = BeautifulSoup(response.data, features="html.parser")
 
         assert len(document.find(id='treasures').find_all('li')) == 100
+
+    def test_sorts(self):
+        """Should sort the whole catalog by the requested field."""
+        for i in range(1000):
+            r.zadd('treasures.views', {i: 1000 - i})
+            r.zadd('treasures.users', {i: i % 10})
+            r.zadd('treasures.quantity', {i: i})
+
+        for sort, first in [('views', 999), ('users', 999), ('quantity', 0)]:
+            response = self.client.get('/?sort=%s' % sort)
+
+            document = BeautifulSoup(response.data, features="html.parser")
+            treasures = document.find(id='treasures').find_all('li')
+
+            assert len(treasures) == 100
+            assert treasures[0]['id'] == 'listing_%s' % first
+
+    def test_unknown_sort(self):
+        """Should fall back to sorting by value."""
+        response = self.client.get('/?sort=nope')
+
+        document = BeautifulSoup(response.data, features="html.parser")
+
+        assert document.find(id='treasures').find('li')['id'] == 'listing_999'
+
+    def test_get_compact(self):
+        """Should display listings stored in the compact format."""
+        r.set('listings.999.data', encode_listing(fake_treasure('compact')))
+
+        response = self.client.get('/')
+
+        document = BeautifulSoup(response.data, features="html.parser")
+        treasure = document.find(id='listing_compact')
+
+        assert treasure.find('img')['src'] == 'http://google.com'
+        assert treasure.find(title='Heollo').text == 'Heollo'
+
+    def test_get_uses_snapshot(self):
+        """Should display the snapshot when workers have built one."""
+        r.set('treasures.snapshot', json.dumps([compact_listing(fake_treasure('snapshot'))]))
+
+        response = self.client.get('/')
+
+        document = BeautifulSoup(response.data, features="html.parser")
+
+        assert len(document.find(id='treasures').find_all('li')) == 1
+        assert document.find(id='listing_snapshot') is not None
+
+
+class TestReplicaReads(object):
+    """Tests for reading from replicas."""
+    def setup_method(self, method):
+        app.testing = True
+        self.client = app.test_client()
+
+        # Another database stands in for a replica, so reads show which
+        # one they came from
+        self.replica = redis.Redis(
+            host=config['REDIS_CONFIG'].hostname,
+            port=config['REDIS_CONFIG'].port,
+            password=config['REDIS_CONFIG'].password,
+            db=1,
+        )
+
+        r.flushdb()
+        self.replica.flushdb()
+        page_cache.clear()
+
+        for client in (r, self.replica):
+            name = 'primary' if client is r else 'replica'
+            client.set('treasures.snapshot', json.dumps([
+                compact_listing(fake_treasure(name)),
+            ]))
+            client.zadd('treasures', {name: 1})
+            client.set(
+                'listings.%s.data' % name,
+                encode_listing(fake_treasure(name)),
+            )
+
+    def teardown_method(self, method):
+        r.flushdb()
+        self.replica.flushdb()
+
+    def listing_ids(self, response):
+        document = BeautifulSoup(response.data, features="html.parser")
+
+        return [
+            li['id'] for li in document.find(id='treasures').find_all('li')
+        ]
+
+    def test_index(self):
+        """Should read the index page from a replica."""
+        with patch('db.replicas', [self.replica]):
+            response = self.client.get('/')
+
+        assert self.listing_ids(response) == ['listing_replica']
+
+    def test_api(self):
+        """Should read treasures API pages from a replica."""
+        with patch('db.replicas', [self.replica]):
+            response = self.client.get('/api/treasures')
+
+        assert [
+            treasure['listing_id'] for treasure in response.json['treasures']
+        ] == ['replica']
+
+    def test_unreachable(self):
+        """Should read from the primary when the replica can't be reached."""
+        unreachable = redis.Redis(host='localhost', port=1)
+
+        with patch('db.replicas', [unreachable]), \
+                patch.dict('db.replicas_down', clear=True):
+            response = self.client.get('/')
+
+        assert response.status_code == 200
+        assert self.listing_ids(response) == ['listing_primary']
+
+    def test_writes_to_primary(self):
+        """Should keep writes on the primary."""
+        with patch('db.replicas', [self.replica]):
+            self.client.get('/metrics')
+
+        assert r.exists('metrics.samples')
+        assert not self.replica.exists('metrics.samples')
+
+
+class TestIndexCache(object):
+    """Tests for the rendered index page cache."""
+    def setup_method(self, method):
+        app.testing = True
+        self.client = app.test_client()
+
+        r.flushdb()
+        page_cache.clear()
+
+        r.set('treasures.version', 1)
+        r.set('treasures.updated', 1000000000)
+        r.set('treasures.snapshot', json.dumps([]))
+
+    def teardown_method(self, method):
+        r.flushdb()
+
+    def test_reuses_rendered_page(self):
+        """Should serve the cached page until the version changes."""
+        first = self.client.get('/')
+
+        r.set('treasures.snapshot', json.dumps([compact_listing(fake_treasure('new'))]))
+
+        assert self.client.get('/').data == first.data
+
+        r.incr('treasures.version')
+
+        assert b'listing_new' in self.client.get('/').data
+
+    def test_version_matches_snapshot(self):
+        """Should cache a page under the version its snapshot was read with."""
+        r.set('treasures.snapshot', json.dumps([compact_listing(fake_treasure('new'))]))
+        r.set('treasures.version', 2)
+
+        # As if the workers moved on after version 1 was read
+        with app.test_request_context('/'):
+            page = get_page(b'1')
+
+        assert list(page_cache) == [(b'2', 'value')]
+        assert b'data-version="2"' in page['html']
+        assert b'listing_new' in page['html']
+
+    def test_caches_each_sort(self):
+        """Should cache a page for each sort order."""
+        r.zadd('treasures.views', {'1': 1})
+        r.set('listings.1.data', encode_listing(fake_treasure(1)))
+
+        self.client.get('/')
+        views = self.client.get('/?sort=views')
+
+        assert b'listing_1' in views.data
+        assert len(page_cache) == 2
+
+    def test_bounded(self):
+        """Should evict the least recently used pages."""
+        for version in range(config['BT_PAGE_CACHE_SIZE'] + 5):
+            r.set('treasures.version', version)
+            self.client.get('/')
+
+        assert len(page_cache) == config['BT_PAGE_CACHE_SIZE']
+
+    def test_not_modified(self):
+        """Should answer conditional requests with a 304."""
+        response = self.client.get('/')
+        etag = response.headers['ETag']
+
+        assert response.headers['Last-Modified'] is not None
+
+        response = self.client.get('/', headers={'If-None-Match': etag})
+
+        assert response.status_code == 304
+        assert response.data == b''
+
+    def test_modified(self):
+        """Should send the page again once the ranking changes."""
+        etag = self.client.get('/').headers['ETag']
+
+        r.set('treasures.snapshot', json.dumps([compact_listing(fake_treasure('new'))]))
+        r.incr('treasures.version')
+        r.incr('treasures.updated')
+
+        response = self.client.get('/', headers={'If-None-Match': etag})
+
+        assert response.status_code == 200
+
+    def test_gzip(self):
+        """Should serve the precompressed page to clients that accept it."""
+        plain = self.client.get('/')
+        response = self.client.get('/', headers={'Accept-Encoding': 'gzip'})
+
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.headers['ETag'] != plain.headers['ETag']
+        assert gzip.decompress(response.data) == plain.data
+
+    def test_gzip_refused(self):
+        """Should serve the plain page to clients that refuse gzip."""
+        plain = self.client.get('/')
+        response = self.client.get('/', headers={
+            'Accept-Encoding': 'gzip;q=0, identity',
+        })
+
+        assert 'Content-Encoding' not in response.headers
+        assert response.data == plain.data
+
+
+class TestApiTreasures(object):
+    """Tests for the treasures JSON API."""
+    def setup_method(self, method):
+        app.testing = True
+        self.client = app.test_client()
+
+        r.flushdb()
+
+        for i in range(120):
+            r.zadd('treasures', {i: i})
+            r.set('listings.%s.data' % i, encode_listing(fake_treasure(i)))
+
+        r.set('treasures.version', 1)
+
+    def teardown_method(self, method):
+        r.flushdb()
+
+    def page_ids(self, response):
+        return [treasure['listing_id'] for treasure in response.json['treasures']]
+
+    def test_first_page(self):
+        """Should return the best treasures first."""
+        response = self.client.get('/api/treasures?limit=10')
+
+        assert response.status_code == 200
+        assert self.page_ids(response) == list(range(119, 109, -1))
+        assert response.json['treasures'][0]['score'] == 119
+        assert response.json['next'] is not None
+
+    def test_pages_to_the_end(self):
+        """Should follow cursors through the whole ranking."""
+        ids = []
+        cursor = ''
+
+        while cursor is not None:
+            response = self.client.get(
+                '/api/treasures?limit=50&cursor=%s' % cursor if cursor else
+                '/api/treasures?limit=50'
+            )
+            ids.extend(self.page_ids(response))
+            cursor = response.json['next']
+
+        assert ids == list(range(119, -1, -1))
+
+    def test_stable_cursor(self):
+        """Should carry on from the same place as the ranking changes."""
+        first = self.client.get('/api/treasures?limit=10')
+
+        r.zadd('treasures', {'1000': 1000})
+        r.zrem('treasures', '119')
+
+        response = self.client.get(
+            '/api/treasures?limit=10&cursor=%s' % first.json['next']
+        )
+
+        assert self.page_ids(response) == list(range(109, 99, -1))
+
+    def test_ties(self):
+        """Should page through listings with the same score."""
+        r.flushdb()
+        for i in range(5):
+            r.zadd('treasures', {i: 1})
+            r.set('listings.%s.data' % i, encode_listing(fake_treasure(i)))
+
+        first = self.client.get('/api/treasures?limit=2')
+        second = self.client.get(
+            '/api/treasures?limit=10&cursor=%s' % first.json['next']
+        )
+
+        assert self.page_ids(first) + self.page_ids(second) == [4, 3, 2, 1, 0]
+
+    def test_many_ties(self):
+        """Should only read the ties after the cursor."""
+        r.flushdb()
+        for i in range(30):
+            r.zadd('treasures.quantity', {i: 1})
+            r.zadd('treasures', {i: i})
+            r.set('listings.%s.data' % i, encode_listing(fake_treasure(i)))
+
+        ids = []
+        cursor = None
+        zrangebyscore = redis.client.Pipeline.zrangebyscore
+        with patch.object(
+            redis.client.Pipeline, 'zrangebyscore', autospec=True,
+            side_effect=zrangebyscore,
+        ) as ranges:
+            while True:
+                response = self.client.get(
+                    '/api/treasures?sort=quantity&limit=4' +
+                    ('&cursor=%s' % cursor if cursor else '')
+                )
+                ids.extend(self.page_ids(response))
+                cursor = response.json['next']
+
+                if cursor is None:
+                    break
+
+        assert ids == sorted(ids, key=str)
+        assert len(ids) == 30
+        assert all(
+            tie_range.kwargs['num'] == 5
+            for tie_range in ranges.call_args_list
+        )
+        assert [tie_range.kwargs['start'] for tie_range in (
+            ranges.call_args_list[::2]
+        )] == list(range(4, 30, 4))
+
+    def test_sorted_scores(self):
+        """Should give the value score whatever the sort order."""
+        r.zadd('treasures.views', {'3': 1000})
+
+        response = self.client.get('/api/treasures?sort=views&limit=1')
+
+        assert response.json['treasures'][0]['listing_id'] == 3
+        assert response.json['treasures'][0]['score'] == 3
+
+    def test_sorted_pages(self):
+        """Should page through other sort orders, lowest first for views."""
+        r.flushdb()
+        for i in range(5):
+            r.zadd('treasures', {i: i})
+            r.zadd('treasures.views', {i: i // 2})
+            r.set('listings.%s.data' % i, encode_listing(fake_treasure(i)))
+
+        first = self.client.get('/api/treasures?sort=views&limit=3')
+        second = self.client.get(
+            '/api/treasures?sort=views&limit=3&cursor=%s' % first.json['next']
+        )
+
+        assert self.page_ids(first) == [0, 1, 2]
+        assert self.page_ids(second) == [3, 4]
+        assert second.json['next'] is None
+
+    def test_unknown_format(self):
+        """Should leave out listings stored in a format it can't decode."""
+        r.set('listings.119.data', msgpack.packb([FORMAT_VERSION + 1]))
+
+        response = self.client.get('/api/treasures?limit=2')
+
+        assert response.status_code == 200
+        assert self.page_ids(response) == [118]
+
+    def test_fields(self):
+        """Should only return the requested fields."""
+        response = self.client.get('/api/treasures?limit=1&fields=title,score')
+
+        assert response.json['treasures'] == [{'title': 'HEllo', 'score': 119}]
+
+    def test_bad_requests(self):
+        """Should refuse bad parameters."""
+        for query in [
+            'limit=0', 'limit=100000', 'limit=lots', 'cursor=nope',
+            'cursor=1:1', 'cursor=1:0:1', 'cursor=nan:1:1', 'cursor=inf:1:1',
+            'cursor=-inf:1:1',
+            'fields=password', 'sort=nope',
+        ]:
+            response = self.client.get('/api/treasures?%s' % query)
+
+            assert response.status_code == 400
+
+    def test_cache_headers(self):
+        """Should let clients cache pages until the version changes."""
+        response = self.client.get('/api/treasures')
+
+        assert response.headers['ETag']
+        assert 'max-age' in response.headers['Cache-Control']
+
+        cached = self.client.get('/api/treasures', headers={
+            'If-None-Match': response.headers['ETag'],
+        })
+        assert cached.status_code == 304
+
+        r.incr('treasures.version')
+
+        changed = self.client.get('/api/treasures', headers={
+            'If-None-Match': response.headers['ETag'],
+        })
+        assert changed.status_code == 200
+
+
+class TestStream(object):
+    """Tests for streaming rank deltas to browsers."""
+    def setup_method(self, method):
+        app.testing = True
+        self.client = app.test_client()
+
+        r.flushdb()
+        page_cache.clear()
+
+        self.fan_out_patch = patch('app.start_fan_out')
+        self.fan_out_patch.start()
+
+    def teardown_method(self, method):
+        self.fan_out_patch.stop()
+        stream_queues.clear()
+
+        r.flushdb()
+
+    def test_streams_deltas(self):
+        """Should send broadcast deltas as Server-Sent Events."""
+        response = self.client.get('/stream', buffered=False)
+        events = iter(response.response)
+
+        assert response.mimetype == 'text/event-stream'
+        assert next(events).startswith(b'retry:')
+
+        broadcast('{"version": 2, "deltas": []}')
+
+        assert next(events) == b'data: {"version": 2, "deltas": []}\n\n'
+
+        response.close()
+        assert not stream_queues
+
+    def test_keepalive(self):
+        """Should keep idle connections open."""
+        with patch.dict(config, {'BT_STREAM_KEEPALIVE': 0.01}):
+            response = self.client.get('/stream', buffered=False)
+            events = iter(response.response)
+            next(events)
+
+            assert next(events) == b': keepalive\n\n'
+
+        response.close()
+
+    def test_drops_slow_streams(self):
+        """Should drop streams that fall too far behind."""
+        with patch.dict(config, {'BT_STREAM_QUEUE_SIZE': 2}):
+            response = self.client.get('/stream', buffered=False)
+
+        for version in range(3):
+            broadcast('{"version": %s}' % version)
+
+        assert not stream_queues
+
+        events = list(response.response)
+
+        assert events[1:] == [
+            b'data: {"version": 0}\n\n', b'data: {"version": 1}\n\n',
+        ]
+
+    def test_index_version(self):
+        """Should tell the page which ranking version it shows."""
+        r.set('treasures.version', 7)
+        r.set('treasures.snapshot', json.dumps([
+            compact_listing(fake_treasure(1)),
+        ]))
+
+        response = self.client.get('/')
+
+        document = BeautifulSoup(response.data, features="html.parser")
+        assert document.find(id='treasures')['data-version'] == '7'
@@ -0,0 +1,164 @@
+"""
+Tests for the per-process Redis client.
+"""
+import os
+import socket
+import subprocess
+import sys
+from unittest.mock import patch, Mock
+from urllib.parse import urlparse
+
+import redis
+
+import db
+from config import config
+from db import LazyRedis, get_redis, r, read
+
+
+class TestLazyRedis(object):
+    """Tests for making Redis clients lazily, once per process."""
+    def test_lazy(self):
+        """Should not make a client until one is needed."""
+        factory = Mock()
+        lazy = LazyRedis(factory)
+
+        lazy.register_script('return 1')
+
+        assert not factory.called
+
+        lazy.get('a')
+
+        factory.return_value.get.assert_called_with('a')
+
+    def test_per_process(self):
+        """Should make a new client in a forked process."""
+        factory = Mock(side_effect=lambda: Mock())
+        lazy = LazyRedis(factory)
+
+        first = lazy.get_client()
+        assert lazy.get_client() is first
+
+        with patch('db.os.getpid', return_value=os.getpid() + 1):
+            assert lazy.get_client() is not first
+
+        assert factory.call_count == 2
+
+    def test_scripts(self):
+        """Should run scripts registered before the client was made."""
+        script = r.register_script('return ARGV[1]')
+
+        assert script(args=['hello']) == b'hello'
+
+    def test_pool(self):
+        """Should use a bounded pool with health checks."""
+        pool = r.connection_pool
+
+        assert pool.max_connections == 50
+        assert pool.connection_kwargs['health_check_interval'] == 30
+
+
+class TestReplicas(object):
+    """Tests for routing reads to replicas."""
+    def setup_method(self, method):
+        self.replicas = [Mock(name='first'), Mock(name='second')]
+        self.patches = [
+            patch('db.replicas', self.replicas),
+            patch.dict('db.replicas_down', clear=True),
+        ]
+        for replica_patch in self.patches:
+            replica_patch.start()
+
+    def teardown_method(self, method):
+        for replica_patch in self.patches:
+            replica_patch.stop()
+
+    def test_primary(self):
+        """Should read from the primary without replicas."""
+        with patch('db.replicas', []):
+            assert read(lambda client: client) is r
+
+    def test_round_robin(self):
+        """Should take turns reading from each replica."""
+        clients = [read(lambda client: client) for _ in range(4)]
+
+        assert clients[0] is not clients[1]
+        assert set(clients[:2]) == set(self.replicas)
+        assert clients[:2] == clients[2:]
+
+    def test_failover(self):
+        """Should fall back to the next replica, then the primary."""
+        def reader(client):
+            if client is not r:
+                raise redis.ConnectionError()
+
+            return client
+
+        assert read(reader) is r
+        assert set(db.replicas_down) == set(self.replicas)
+
+    def test_busy(self):
+        """Should fall back without marking a replica with no free
+        connections as down.
+        """
+        busy = redis.Redis(connection_pool=redis.BlockingConnectionPool(
+            host=config['REDIS_CONFIG'].hostname,
+            port=config['REDIS_CONFIG'].port,
+            password=config['REDIS_CONFIG'].password,
+            max_connections=1,
+            timeout=0.01,
+        ))
+        held = busy.connection_pool.get_connection('GET')
+
+        with patch('db.replicas', [busy]):
+            assert read(lambda client: client.ping() and client) is r
+
+        busy.connection_pool.release(held)
+
+        assert busy not in db.replicas_down
+
+    def test_unresponsive(self):
+        """Should give up on a replica that stops answering."""
+        silent = socket.socket()
+        silent.bind(('127.0.0.1', 0))
+        silent.listen(1)
+        url = urlparse('redis://127.0.0.1:%s' % silent.getsockname()[1])
+
+        try:
+            unresponsive = get_redis(url, timeout=0.1)
+
+            with patch('db.replicas', [unresponsive]):
+                assert read(lambda client: client.get('a') or client) is r
+        finally:
+            silent.close()
+
+        assert unresponsive in db.replicas_down
+
+    def test_replica_timeout(self):
+        """Should only time out commands on replicas."""
+        assert r.connection_pool.connection_kwargs['socket_timeout'] is None
+        assert get_redis(timeout=2).connection_pool.connection_kwargs[
+            'socket_timeout'
+        ] == 2
+
+    def test_skip_down(self):
+        """Should skip an unreachable replica until it's time to retry."""
+        down, up = self.replicas
+        db.replicas_down[down] = float('inf')
+
+        assert [read(lambda client: client) for _ in range(2)] == [up, up]
+
+        db.replicas_down[down] = 0
+
+        assert down in [read(lambda client: client) for _ in range(2)]
+
+
+class TestStartup(object):
+    """Tests for what each process type loads."""
+    def test_workers_skip_flask(self):
+        """Should not load Flask in worker processes."""
+        loaded = subprocess.check_output([
+            sys.executable, '-c', 'import sys, tasks; print(sorted(sys.modules))',
+        ], cwd=os.path.join(os.path.dirname(__file__), '..'))
+
+        assert b"'flask'" not in loaded
+        assert b"'jinja2'" not in loaded
@@ -0,0 +1,103 @@
+"""
+Tests for listing storage.
+"""
+import json
+
+import msgpack
+
+from listings import (
+    FIELDS,
+    FORMAT_VERSION,
+    compact_listing,
+    decode_listing,
+    decode_stored_listing,
+    encode_listing,
+    is_legacy,
+)
+
+
+def api_listing():
+    """A fake listing as the API returns it."""
+    return {
+        'listing_id': 1,
+        'state': 'active',
+        'title': 'Treasure',
+        'url': 'http://google.com',
+        'price': '12.00',
+        'currency_code': 'USD',
+        'views': 10,
+        'quantity': 2,
+        'users': 3,
+        'materials': ['silver', 'gold'],
+        'original_creation_tsz': 1300000000,
+        'Images': [{'url_170x135': 'http://google.com/image'}],
+        'Shop': {'shop_name': 'Shoppe', 'url': 'http://google.com/shop'},
+    }
+
+
+class TestListingStorage(object):
+    """Tests for encoding and decoding stored listings."""
+    def test_round_trip(self):
+        """Should decode what it encodes."""
+        listing = api_listing()
+
+        assert decode_listing(encode_listing(listing)) == {
+            'listing_id': 1,
+            'title': 'Treasure',
+            'url': 'http://google.com',
+            'price': '12.00',
+            'currency_code': 'USD',
+            'views': 10,
+            'quantity': 2,
+            'users': 3,
+            'gold': True,
+            'original_creation_tsz': 1300000000,
+            'image_url': 'http://google.com/image',
+            'shop_name': 'Shoppe',
+            'shop_url': 'http://google.com/shop',
+        }
+
+    def test_smaller(self):
+        """Should store less than the whole API listing."""
+        listing = api_listing()
+
+        assert len(encode_listing(listing)) < len(json.dumps(listing))
+
+    def test_decodes_legacy(self):
+        """Should decode whole API listings stored before the compact format."""
+        data = json.dumps(api_listing()).encode('utf-8')
+
+        assert is_legacy(data)
+        assert decode_listing(data) == compact_listing(api_listing())
+
+    def test_unknown_version(self):
+        """Should refuse listings stored in a format it doesn't know."""
+        data = msgpack.packb([FORMAT_VERSION + 1] + [None] * len(FIELDS))
+
+        try:
+            decode_listing(data)
+        except ValueError:
+            pass
+        else:
+            assert False, 'Expected a ValueError'
+
+    def test_skips_unknown_version(self):
+        """Should skip listings it can't decode or that aren't stored."""
+        data = msgpack.packb([FORMAT_VERSION + 1] + [None] * len(FIELDS))
+
+        assert decode_stored_listing(1, data) is None
+        assert decode_stored_listing(1, None) is None
+        assert decode_stored_listing(1, encode_listing(api_listing())) == (
+            compact_listing(api_listing())
+        )
+
+    def test_missing_images(self):
+        """Should cope with listings that have no images or shop."""
+        listing = api_listing()
+        del listing['Images']
+        del listing['Shop']
+
+        data = decode_listing(encode_listing(listing))
+
+        assert data['image_url'] is None
+        assert data['shop_name'] is None
@@ -0,0 +1,210 @@
+"""
+Tests for collecting and exposing metrics.
+"""
+from unittest.mock import patch
+
+import metrics
+from app import app, r
+
+
+def reset_metrics():
+    """Forgets metrics collected in this process."""
+    metrics.samples.clear()
+    metrics.types.clear()
+    del metrics.task_stack[:]
+
+
+class TestMetrics(object):
+    """Tests for collecting metrics."""
+    def setup_method(self, method):
+        r.flushdb()
+        reset_metrics()
+
+    def teardown_method(self, method):
+        r.flushdb()
+        reset_metrics()
+
+    def test_counter(self):
+        """Should add up counts with the same labels."""
+        metrics.count('bt_things_total', task='a')
+        metrics.count('bt_things_total', 2, task='a')
+        metrics.count('bt_things_total', task='b')
+        metrics.flush(r)
+
+        text = metrics.render(r)
+
+        assert '# TYPE bt_things_total counter' in text
+        assert 'bt_things_total{task="a"} 3.0' in text
+        assert 'bt_things_total{task="b"} 1.0' in text
+
+    def test_histogram(self):
+        """Should count observations into cumulative buckets, in order."""
+        metrics.observe('bt_wait_seconds', 0.2, task='a')
+        metrics.observe('bt_wait_seconds', 20, task='a')
+        metrics.flush(r)
+
+        lines = metrics.render(r).splitlines()
+        buckets = [line for line in lines if '_bucket' in line]
+
+        assert lines[0] == '# TYPE bt_wait_seconds histogram'
+        assert buckets[0] == 'bt_wait_seconds_bucket{task="a",le="0.005"} 0.0'
+        assert 'bt_wait_seconds_bucket{task="a",le="0.25"} 1.0' in buckets
+        assert 'bt_wait_seconds_bucket{task="a",le="30.0"} 2.0' in buckets
+        assert buckets[-1] == 'bt_wait_seconds_bucket{task="a",le="+Inf"} 2.0'
+        assert 'bt_wait_seconds_sum{task="a"} 20.2' in lines
+        assert 'bt_wait_seconds_count{task="a"} 2.0' in lines
+
+    def test_escapes_labels(self):
+        """Should escape quotes in label values."""
+        assert metrics.sample_name('bt_x', {'a': 'say "hi"'}) == (
+            'bt_x{a="say \\"hi\\""}'
+        )
+
+    def test_aggregates_processes(self):
+        """Should add up what each process flushes."""
+        metrics.count('bt_things_total')
+        metrics.flush(r)
+
+        # Another worker with its own numbers
+        metrics.count('bt_things_total', 4)
+        metrics.flush(r)
+
+        assert 'bt_things_total 5.0' in metrics.render(r)
+
+    def test_flush_interval(self):
+        """Should hold on to metrics until the interval has passed."""
+        metrics.count('bt_things_total')
+        metrics.flush(r, interval=3600)
+
+        assert not r.exists(metrics.SAMPLES)
+
+    def test_counts_redis_calls(self):
+        """Should count a task's Redis commands and round trips."""
+        metrics.count_redis_calls()
+        metrics.start_task('tasks.example')
+
+        r.get('a')
+        pipe = r.pipeline()
+        pipe.get('a')
+        pipe.get('b')
+        pipe.execute()
+
+        metrics.finish_task('tasks.example', 'SUCCESS')
+        metrics.flush(r)
+
+        text = metrics.render(r)
+
+        assert 'bt_redis_commands_total{task="tasks.example"} 3.0' in text
+        assert 'bt_redis_round_trips_total{task="tasks.example"} 2.0' in text
+        assert (
+            'bt_task_duration_seconds_count'
+            '{state="SUCCESS",task="tasks.example"} 1.0'
+        ) in text
+
+
+class TestTaskMetrics(object):
+    """Tests for the metrics recorded by tasks."""
+    def setup_method(self, method):
+        r.flushdb()
+        reset_metrics()
+
+    def teardown_method(self, method):
+        r.flushdb()
+        reset_metrics()
+
+    @patch('tasks.get_listing_data')
+    def test_fetch_detail(self, get_listing_data):
+        """Should time fetch_detail and count what it stored."""
+        from tasks import fetch_detail
+
+        get_listing_data.return_value = [
+            {
+                'listing_id': '1',
+                'state': 'sold_out',
+                'quantity': 1,
+                'views': 1,
+                'materials': [],
+            },
+        ]
+
+        fetch_detail.apply(args=['1'])
+
+        text = metrics.render(r)
+
+        assert (
+            'bt_task_duration_seconds_count'
+            '{state="SUCCESS",task="tasks.fetch_detail"} 1.0'
+        ) in text
+        assert 'bt_stage_duration_seconds_count{stage="store_listings"} 1.0' in (
+            text
+        )
+        assert 'bt_listings_total{outcome="purged"} 1.0' in text
+        assert 'bt_listings_total{outcome="scored"} 0.0' in text
+
+    @patch('tasks.get_treasuries')
+    def test_dead_filter(self, get_treasuries):
+        """Should count each listing checked for being dead once."""
+        from tasks import fetch_listings
+
+        get_treasuries.return_value = [
+            {
+                'id': treasury_id,
+                'creation_tsz': 1,
+                'user_id': treasury_id,
+                'listings': [{'data': {'listing_id': 1}}],
+            }
+            for treasury_id in (1, 2)
+        ]
+
+        fetch_listings.apply()
+
+        text = metrics.render(r)
+
+        assert 'bt_dead_filter_total{result="hit"} 0.0' in text
+        assert 'bt_dead_filter_total{result="miss"} 1.0' in text
+
+    @patch('tasks.time.sleep')
+    @patch('tasks.ratelimit')
+    @patch('tasks.get_session')
+    def test_api_latency(self, get_session, ratelimit, sleep):
+        """Should time API calls by endpoint and status."""
+        from tasks import api_call
+
+        get_session.return_value.get.return_value.status_code = 200
+        get_session.return_value.get.return_value.json.return_value = {}
+
+        api_call('listings/1,2,3')
+        metrics.flush(r)
+
+        assert (
+            'bt_api_request_duration_seconds_count'
+            '{endpoint="listings",status="200"} 1.0'
+        ) in metrics.render(r)
+
+
+class TestMetricsEndpoint(object):
+    """Tests for the metrics endpoint."""
+    def setup_method(self, method):
+        app.testing = True
+        self.client = app.test_client()
+
+        r.flushdb()
+        reset_metrics()
+
+    def teardown_method(self, method):
+        r.flushdb()
+        reset_metrics()
+
+    def test_metrics(self):
+        """Should serve web tier timings as Prometheus text."""
+        r.set('treasures.version', 1)
+        r.set('treasures.snapshot', '[]')
+
+        self.client.get('/')
+        response = self.client.get('/metrics')
+
+        assert response.status_code == 200
+        assert response.headers['Content-Type'].startswith('text/plain')
+        assert b'bt_web_duration_seconds_count{stage="render"} 1.0' in (
+            response.data
+        )
@@ -0,0 +1,73 @@
+"""
+Tests for the dead listing filter.
+"""
+from unittest.mock import patch
+
+import metrics
+from config import config
+from db import r
+
+from negcache import add, filter_keys, filter_live, filter_size, stats
+
+
+class TestNegativeCache(object):
+    """Tests for remembering dead listings."""
+    def setup_method(self, method):
+        r.flushdb()
+        metrics.samples.clear()
+
+    def teardown_method(self, method):
+        r.flushdb()
+        metrics.samples.clear()
+
+    def test_filter_size(self):
+        """Should size the filter for the configured error rate."""
+        bits, hashes = filter_size()
+
+        assert 9 < bits / config['BT_DEAD_CAPACITY'] < 10
+        assert hashes == 7
+
+    def test_filters_dead(self):
+        """Should drop dead listings and keep the rest in order."""
+        add(['2', '4'])
+
+        assert filter_live(['1', '2', '3', '4', '5']) == ['1', '3', '5']
+
+    def test_false_positives(self):
+        """Should rarely mistake live listings for dead ones."""
+        add(range(1000))
+
+        live = filter_live(range(1000, 2000))
+
+        assert len(live) > 980
+
+    def test_expires(self):
+        """Should forget dead listings after two periods."""
+        ttl = config['BT_DEAD_TTL']
+
+        with patch('negcache.time.time', return_value=ttl * 10):
+            add(['1'])
+
+        with patch('negcache.time.time', return_value=ttl * 11):
+            assert filter_live(['1']) == []
+
+        with patch('negcache.time.time', return_value=ttl * 12):
+            assert filter_live(['1']) == ['1']
+
+        assert 0 < r.ttl(filter_keys(ttl * 10)[0]) <= 2 * ttl
+
+    def test_stats(self):
+        """Should count hits and misses."""
+        add(['1'])
+        filter_live(['1', '2', '3'])
+        metrics.flush(r)
+
+        assert stats() == {'hits': 1, 'misses': 2}
+
+    def test_uncounted(self):
+        """Should leave the counts alone for listings already counted."""
+        filter_live(['1'])
+        filter_live(['1'], count=False)
+        metrics.flush(r)
+
+        assert stats() == {'hits': 0, 'misses': 1}
@@ -0,0 +1,95 @@
+"""
+Tests for the sampling profiler hooks.
+"""
+import os
+import pstats
+from unittest.mock import patch
+
+from flask import Flask
+
+import profiling
+
+
+def fake_app(tmp_path, rate, keep=100):
+    """A Flask app with profiling configured."""
+    fake = Flask(__name__)
+    fake.config.update({
+        'BT_PROFILE_RATE': rate,
+        'BT_PROFILE_DIR': str(tmp_path),
+        'BT_PROFILE_KEEP': keep,
+    })
+
+    @fake.route('/things/<thing>')
+    def thing(thing):
+        return thing
+
+    profiling.profile_requests(fake)
+
+    return fake
+
+
+class TestProfileRequests(object):
+    """Tests for profiling web requests."""
+    def test_disabled(self, tmp_path):
+        """Should not hook into requests or tasks at all when disabled."""
+        fake = fake_app(tmp_path, 0)
+
+        assert not fake.before_request_funcs
+        assert not fake.teardown_request_funcs
+
+        fake.test_client().get('/things/1')
+
+        assert not os.listdir(tmp_path)
+        assert profiling.profile_tasks(fake.config) is None
+
+    def test_profiles_requests(self, tmp_path):
+        """Should write a profile tagged with the route and arguments."""
+        fake_app(tmp_path, 1).test_client().get('/things/1?a=1&b=2')
+
+        filename, = os.listdir(tmp_path)
+
+        assert filename.endswith('-web_things_thing_-2args.prof')
+        assert pstats.Stats(os.path.join(tmp_path, filename)).total_calls
+
+    def test_samples(self, tmp_path):
+        """Should only profile the sampled fraction of requests."""
+        client = fake_app(tmp_path, 0.5).test_client()
+
+        with patch('profiling.random.random', side_effect=[0.9, 0.1]):
+            client.get('/things/1')
+            client.get('/things/2')
+
+        assert len(os.listdir(tmp_path)) == 1
+
+    def test_rotates(self, tmp_path):
+        """Should keep only the newest profiles."""
+        client = fake_app(tmp_path, 1, keep=3).test_client()
+
+        for i in range(5):
+            client.get('/things/%s' % i)
+
+        assert len(os.listdir(tmp_path)) == 3
+
+
+class TestProfileTasks(object):
+    """Tests for profiling Celery tasks."""
+    def test_profiles_tasks(self, tmp_path):
+        """Should write a profile tagged with the task and arguments."""
+        from celery.signals import task_postrun, task_prerun
+        from tasks import config, fetch_detail
+
+        with patch.dict(config, {
+            'BT_PROFILE_RATE': 1, 'BT_PROFILE_DIR': str(tmp_path),
+        }):
+            prerun, postrun = profiling.profile_tasks(config)
+
+        try:
+            with patch('tasks.get_listing_data', return_value=[]):
+                fetch_detail.apply(args=['1', '2', '3'])
+        finally:
+            task_prerun.disconnect(prerun)
+            task_postrun.disconnect(postrun)
+
+        filename, = os.listdir(tmp_path)
+
+        assert filename.endswith('-tasks.fetch_detail-3args.prof')
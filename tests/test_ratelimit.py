@@ -0,0 +1,137 @@
+"""
+Tests for the shared Etsy API rate limiter.
+"""
+from unittest.mock import patch, Mock
+
+from config import config
+from db import r
+
+from ratelimit import BUCKET, acquire, available, record_response
+
+
+def fake_response(status_code=200, remaining=None):
+    """A fake API response."""
+    response = Mock(status_code=status_code, headers={})
+
+    if remaining is not None:
+        response.headers = {
+            'X-RateLimit-Limit': '10000',
+            'X-RateLimit-Remaining': str(remaining),
+        }
+
+    return response
+
+
+@patch('ratelimit.time.sleep')
+class TestAcquire(object):
+    """Tests for taking tokens from the shared bucket."""
+    def setup_method(self, method):
+        r.flushdb()
+
+    def teardown_method(self, method):
+        r.flushdb()
+
+    def test_burst(self, sleep):
+        """Should allow a burst of calls without waiting."""
+        for _ in range(config['BT_API_BURST']):
+            acquire()
+
+        assert not sleep.called
+
+    def test_waits_when_empty(self, sleep):
+        """Should wait for the bucket to refill once it's empty."""
+        for _ in range(config['BT_API_BURST'] + 1):
+            acquire()
+
+        assert sleep.call_count == 1
+        wait = sleep.call_args[0][0]
+        assert 0 < wait <= 1 / config['BT_API_RATE']
+
+    def test_queues_waiters(self, sleep):
+        """Should make each caller in line wait longer than the last."""
+        for _ in range(config['BT_API_BURST'] + 2):
+            acquire()
+
+        first, second = [args[0] for args, _ in sleep.call_args_list]
+        assert second > first
+
+    def test_backs_off(self, sleep):
+        """Should hold every call until the backoff has passed."""
+        record_response(fake_response(429))
+
+        with patch('ratelimit.time.time', side_effect=[
+            float(r.hget(BUCKET, 'backoff_until')) - 1,
+            float(r.hget(BUCKET, 'backoff_until')) + 1,
+        ]):
+            acquire()
+
+        assert sleep.call_count == 1
+        assert sleep.call_args[0][0] == 1
+
+
+class TestAvailable(object):
+    """Tests for estimating the API budget."""
+    def setup_method(self, method):
+        r.flushdb()
+
+    def teardown_method(self, method):
+        r.flushdb()
+
+    @patch('ratelimit.time.sleep')
+    def test_available(self, sleep):
+        """Should count the tokens left in the bucket."""
+        assert available() == config['BT_API_BURST']
+
+        acquire()
+
+        assert config['BT_API_BURST'] - 1 <= available() < (
+            config['BT_API_BURST']
+        )
+
+    def test_none_while_backing_off(self):
+        """Should have no budget while backing off."""
+        record_response(fake_response(429))
+
+        assert available() == 0
+
+
+class TestRecordResponse(object):
+    """Tests for adapting the shared bucket to API responses."""
+    def setup_method(self, method):
+        r.flushdb()
+
+    def teardown_method(self, method):
+        r.flushdb()
+
+    def test_adapts_rate(self):
+        """Should spread the remaining quota over the window."""
+        record_response(fake_response(remaining=8640))
+
+        assert float(r.hget(BUCKET, 'rate')) == 0.1
+
+    def test_rate_bounds(self):
+        """Should keep the rate within the configured bounds."""
+        record_response(fake_response(remaining=0))
+        assert float(r.hget(BUCKET, 'rate')) == config['BT_API_MIN_RATE']
+
+        record_response(fake_response(remaining=10 ** 9))
+        assert float(r.hget(BUCKET, 'rate')) == config['BT_API_MAX_RATE']
+
+    def test_exponential_backoff(self):
+        """Should double the backoff for each error in a row."""
+        with patch('ratelimit.time.time', return_value=1000):
+            record_response(fake_response(503))
+            first = float(r.hget(BUCKET, 'backoff_until'))
+
+            record_response(fake_response(429))
+            second = float(r.hget(BUCKET, 'backoff_until'))
+
+        assert second - 1000 == 2 * (first - 1000)
+
+    def test_success_resets_backoff(self):
+        """Should start backing off from scratch after a success."""
+        record_response(fake_response(503))
+        record_response(fake_response(503))
+        record_response(fake_response(200))
+
+        assert int(r.hget(BUCKET, 'failures')) == 0
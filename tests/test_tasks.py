@@ -1,18 +1,43 @@
 import json
+import random
 import time
-from unittest.mock import patch, call, Mock
+from unittest.mock import patch, call, Mock, ANY
 
-from app import r
+import msgpack
+import requests
+
+import negcache
+from config import config
+from db import r
+from listings import (
+    FIELDS, FORMAT_VERSION, compact_listing, decode_listing, encode_listing,
+    is_legacy,
+)
+from treasures import DELTAS_CHANNEL, SORT_FIELDS
 
 from tasks import (
+    api_call,
+    batches,
+    get_session,
+    first_user_key,
     get_treasuries,
     unique_users,
     fetch_listings,
     get_listing_data,
     fetch_detail,
+    index_treasures,
     score_listing,
     process_listings,
+    rank_deltas,
+    refresh_treasures,
+    refresh_ttl,
+    flush_listings,
     scrub_scrubs,
+    rescore_treasures,
+    trim_treasures,
+    update_snapshot,
+    migrate_listing_data,
+    index_single_users,
 )
 
 
@@ -86,7 +111,12 @@ def assert_does_not_exist(listing_id):
     """Asserts that listing data does not exist for listing_id."""
     assert not r.exists('listings.%s.data' % listing_id)
     assert not r.exists('listings.%s.users' % listing_id)
+    assert not r.hexists(first_user_key(listing_id), listing_id)
     assert r.zrank('treasures', listing_id) is None
+    assert r.zrank('listings.single', listing_id) is None
+
+    for field in SORT_FIELDS:
+        assert r.zrank('treasures.%s' % field, listing_id) is None
 
 
 def store_fake_data(listing_id, score=9000):
@@ -95,6 +125,75 @@ def store_fake_data(listing_id, score=9000):
     r.sadd('listings.%s.users' % listing_id, '999')
     r.zadd('treasures', {listing_id: score})
 
+    for field in SORT_FIELDS:
+        r.zadd('treasures.%s' % field, {listing_id: score})
+
+
+@patch('tasks.time.sleep')
+@patch('tasks.ratelimit', new=Mock())
+@patch('tasks.get_session')
+class TestApiCall(object):
+    """Tests for calling the Etsy API."""
+    def test_returns_json(self, get_session, sleep):
+        """Should return the decoded response with pooled connections."""
+        get_session.return_value.get.return_value = Mock(
+            status_code=200, json=Mock(return_value={'results': []}),
+        )
+
+        assert api_call('treasuries') == {'results': []}
+        assert get_session.return_value.get.call_args[1]['timeout'] is not None
+        assert not sleep.called
+
+    def test_retries_connection_errors(self, get_session, sleep):
+        """Should retry after connection errors and timeouts."""
+        get_session.return_value.get.side_effect = [
+            requests.ConnectionError(),
+            requests.Timeout(),
+            Mock(status_code=200, json=Mock(return_value={'results': []})),
+        ]
+
+        assert api_call('treasuries') == {'results': []}
+        assert sleep.call_count == 2
+
+    def test_retries_transient_responses(self, get_session, sleep):
+        """Should retry rate limited and server error responses."""
+        get_session.return_value.get.side_effect = [
+            Mock(status_code=503),
+            Mock(status_code=200, json=Mock(return_value={'results': []})),
+        ]
+
+        assert api_call('treasuries') == {'results': []}
+        assert sleep.call_count == 1
+
+    def test_gives_up(self, get_session, sleep):
+        """Should give up after the configured number of retries."""
+        get_session.return_value.get.side_effect = requests.ConnectionError()
+
+        try:
+            api_call('treasuries')
+        except requests.ConnectionError:
+            pass
+        else:
+            assert False, 'Expected a ConnectionError'
+
+        assert get_session.return_value.get.call_count == (
+            config['BT_API_RETRIES'] + 1
+        )
+
+
+class TestGetSession(object):
+    """Tests for the pooled HTTP session."""
+    def test_reuses_session(self):
+        """Should reuse one session within a process."""
+        assert get_session() is get_session()
+
+    def test_new_session_after_fork(self):
+        """Should make a new session in a forked child."""
+        session = get_session()
+
+        with patch('tasks.os.getpid', return_value=-1):
+            assert get_session() is not session
+
 
 @patch('tasks.process_listings')
 class TestFetchListings(object):
@@ -117,6 +216,8 @@ class TestFetchListings(object):
         api_call.return_value = {
             'results': [
                 {
+                    'id': i,
+                    'creation_tsz': 1000 - i,
                     'user_id': str(i),
                     'listings': [
                         {
@@ -136,17 +237,122 @@ class TestFetchListings(object):
         api_call.assert_called_with(
             'treasuries',
             sort_on='created',
-            fields='user_id,listings',
+            sort_order='down',
+            fields='id,creation_tsz,user_id,listings',
+            limit=config['BT_TREASURY_PAGE_SIZE'],
+            offset=0,
         )
         assert result == api_call.return_value['results']
 
+    @patch('tasks.api_call')
+    def test_get_treasuries_since_mark(self, api_call, process_listings):
+        """Should page back to the mark, skipping treasuries already seen."""
+        page_size = config['BT_TREASURY_PAGE_SIZE']
+        treasuries = [
+            {'id': i, 'creation_tsz': 1000 - i // 2, 'user_id': i, 'listings': []}
+            for i in range(page_size * 3)
+        ]
+        api_call.side_effect = [
+            {'results': treasuries[i:i + page_size]}
+            for i in range(0, len(treasuries), page_size)
+        ]
+
+        # Treasuries 150 and 151 were both created at 925, and 150 was seen
+        result = get_treasuries({'creation_tsz': 925, 'ids': [150]})
+
+        assert api_call.call_count == 2
+        assert [t['id'] for t in result] == list(range(150)) + [151]
+
+    @patch('tasks.api_call')
+    def test_get_treasuries_first_page(self, api_call, process_listings):
+        """Should only get the first page without a mark."""
+        page_size = config['BT_TREASURY_PAGE_SIZE']
+        api_call.return_value = {'results': [
+            {'id': i, 'creation_tsz': 1000, 'user_id': i, 'listings': []}
+            for i in range(page_size)
+        ]}
+
+        get_treasuries()
+
+        assert api_call.call_count == 1
+
+    def test_fetch_listings_saves_mark(self, process_listings):
+        """Should remember the newest treasuries seen for the next run."""
+        fake = fake_treasuries()
+        for i, treasury in enumerate(fake):
+            treasury['id'] = i
+            treasury['creation_tsz'] = 1000 if i else 900
+        self.get_treasuries.return_value = fake
+
+        fetch_listings.apply()
+
+        assert json.loads(r.get('treasuries.mark')) == {
+            'creation_tsz': 1000, 'ids': [1, 2],
+        }
+
+        fetch_listings.apply()
+
+        self.get_treasuries.assert_called_with({
+            'creation_tsz': 1000, 'ids': [1, 2],
+        })
+
     def test_fetch_listings_single_user(self, process_listings):
         """Should store user IDs but not fetch items with one user."""
         fetch_listings.apply()
 
-        assert r.smembers('listings.1.users') == set([b'1'])
+        assert r.hget(first_user_key('1'), '1') == b'1'
+        assert not r.exists('listings.1.users')
         assert '1' not in process_listings.call_args[0]
 
+    def test_fetch_listings_second_user(self, process_listings):
+        """Should move a listing's first user into a set with the second."""
+        r.hset(first_user_key('1'), '1', '9')
+
+        fetch_listings.apply()
+
+        assert r.smembers('listings.1.users') == set([b'1', b'9'])
+        assert not r.hexists(first_user_key('1'), '1')
+        assert '1' in process_listings.call_args[0]
+        assert '1' in process_listings.call_args[1]['changed']
+
+    def test_fetch_listings_skips_dead(self, process_listings):
+        """Should not track users for listings known to be dead."""
+        negcache.add(['1'])
+        r.hset(first_user_key('1'), '1', '9')
+
+        fetch_listings.apply()
+
+        assert not r.exists('listings.1.users')
+        assert '1' not in process_listings.call_args[0]
+
+    def test_fetch_listings_same_first_user(self, process_listings):
+        """Should not count a listing's first user twice."""
+        r.hset(first_user_key('1'), '1', '1')
+
+        fetch_listings.apply()
+
+        assert r.hget(first_user_key('1'), '1') == b'1'
+        assert not r.exists('listings.1.users')
+        assert '1' not in process_listings.call_args[0]
+
+    def test_fetch_listings_indexes_single_user(self, process_listings):
+        """Should index single-user listings by when they were first seen."""
+        r.zadd('listings.single', {'1': 1})
+
+        fetch_listings.apply()
+
+        assert r.zscore('listings.single', '1') == 1
+        assert r.zscore('listings.single', '2') is None
+
+    def test_fetch_listings_unindexes_multiple_users(self, process_listings):
+        """Should drop listings from the single-user index once shared."""
+        r.sadd('listings.1.users', '9')
+        r.zadd('listings.single', {'1': 1})
+
+        fetch_listings.apply()
+
+        assert r.zscore('listings.single', '1') is None
+
     def test_fetch_listings_multiple_users(self, process_listings):
         """Should store user IDs and fetch items with more than one user."""
         fetch_listings.apply()
@@ -154,6 +360,31 @@ class TestFetchListings(object):
         assert r.smembers('listings.2.users') == set([b'1', b'2'])
         assert '2' in process_listings.call_args[0]
 
+    def test_fetch_listings_processes_shared(self, process_listings):
+        """Should process exactly the listings with more than one user."""
+        r.sadd('listings.3.users', '7', '8')
+
+        fake = fake_treasuries()
+        fake.append({'user_id': 7, 'listings': [{'data': {'listing_id': '3'}}]})
+        self.get_treasuries.return_value = fake
+
+        fetch_listings.apply()
+
+        assert process_listings.call_args[0] == ('2', '3')
+
+    def test_fetch_listings_changed(self, process_listings):
+        """Should flag listings that gained users as changed."""
+        r.sadd('listings.2.users', '1', '2')
+        r.sadd('listings.3.users', '7', '8')
+
+        fake = fake_treasuries()
+        fake.append({'user_id': 9, 'listings': [{'data': {'listing_id': '3'}}]})
+        self.get_treasuries.return_value = fake
+
+        fetch_listings.apply()
+
+        assert process_listings.call_args[1]['changed'] == ['3']
+
     def test_fetch_listings_single_new_user(self, process_listings):
         """Should fetch existing items with a single new user."""
         r.sadd('listings.1.users', '9')
@@ -187,12 +418,13 @@ class TestScrubScrubs():
         r.flushdb()
 
     def test_scrub_scrubs(self):
-        """Should randomly cull user lists of one user."""
+        """Should cull user lists of one user."""
         for i in range(50):
             r.sadd('listings.%s.users' % i, '1', '2')
 
         for i in range(50, 6000):
             r.sadd('listings.%s.users' % i, '1')
+            r.zadd('listings.single', {i: i})
 
         scrub_scrubs.apply()
 
@@ -204,6 +436,52 @@ class TestScrubScrubs():
         remaining_keys = r.keys('listings.*.users')
         assert len(remaining_keys) <= 5550
         assert len(remaining_keys) >= 5000
+        assert r.zcard('listings.single') == len(remaining_keys) - 50
+
+    def test_scrub_oldest(self):
+        """Should cull the listings that were first seen longest ago."""
+        for i in range(6000):
+            r.sadd('listings.%s.users' % i, '1')
+            r.zadd('listings.single', {i: i})
+
+        scrub_scrubs.apply()
+
+        for i in range(500):
+            assert_does_not_exist(i)
+
+        assert r.scard('listings.500.users') == 1
+
+    def test_scrub_skips_new_users(self):
+        """Should keep indexed listings that have since gained a user."""
+        for i in range(6000):
+            r.sadd('listings.%s.users' % i, '1')
+            r.zadd('listings.single', {i: i})
+
+        r.sadd('listings.0.users', '2')
+
+        scrub_scrubs.apply()
+
+        assert r.scard('listings.0.users') == 2
+        assert r.zscore('listings.single', '0') is None
+
+    def test_index_single_users(self):
+        """Should move existing single-user listings into the index."""
+        for i in range(50):
+            r.sadd('listings.%s.users' % i, '1', '2')
+
+        for i in range(50, 1200):
+            r.sadd('listings.%s.users' % i, '1')
+
+        with patch.dict(config, {'BT_SCRUB_BATCH': 100}):
+            index_single_users.apply()
+
+        assert r.zcard('listings.single') == 1150
+        assert r.zscore('listings.single', '0') is None
+        assert r.zscore('listings.single', '50') is not None
+
+        assert r.scard('listings.0.users') == 2
+        assert not r.exists('listings.50.users')
+        assert r.hget(first_user_key('50'), '50') == b'1'
 
 
 @patch('tasks.get_listing_data', new=Mock(return_value=listings()))
@@ -248,10 +526,47 @@ class TestFetchDetail(object):
         result = fetch_detail.apply(self.listing_ids)
 
         for listing in listings():
-            data = json.loads(r.get('listings.%s.data' % listing['listing_id']))
+            data = decode_listing(
+                r.get('listings.%s.data' % listing['listing_id']),
+            )
 
-            assert data.pop('users') == 3
-            assert data == listing
+            listing['users'] = 3
+            assert data == compact_listing(listing)
+
+    @patch('tasks.score_listing')
+    def test_records_fetch(self, score_listing):
+        """Should record when listings were fetched and that they've landed."""
+        r.zadd('listings.inflight', {'1': 1, '4': 1})
+
+        fetch_detail.apply(['1', '4'])
+
+        for listing_id in self.listing_ids:
+            assert r.zscore('listings.fetched', listing_id) is not None
+
+        assert r.zcard('listings.inflight') == 0
+
+    @patch('tasks.score_listing')
+    def test_updates_snapshot(self, score_listing):
+        """Should rebuild the top treasures snapshot and bump the version."""
+        for i, listing_id in enumerate(self.listing_ids):
+            r.zadd('treasures', {listing_id: i})
+
+        fetch_detail.apply(self.listing_ids)
+
+        snapshot = json.loads(r.get('treasures.snapshot'))
+
+        assert [t['listing_id'] for t in snapshot] == ['3', '2', '1']
+        assert int(r.get('treasures.version')) == 1
+
+    @patch('tasks.score_listing')
+    def test_indexes_sorts(self, score_listing):
+        """Should add each fetched listing to the sort indexes."""
+        fetch_detail.apply(self.listing_ids)
+
+        for listing_id in self.listing_ids:
+            assert r.zscore('treasures.views', listing_id) == 1
+            assert r.zscore('treasures.users', listing_id) == 3
+            assert r.zscore('treasures.quantity', listing_id) == 1
 
     @patch('tasks.score_listing')
     def test_scores_things(self, score_listing):
@@ -260,7 +575,38 @@ class TestFetchDetail(object):
 
         for listing in listings():
             listing['users'] = 3
-            score_listing.assert_any_call(listing)
+            score_listing.assert_any_call(listing, ANY)
+
+    def test_constant_round_trips(self):
+        """Should make the same number of Redis round trips for any chunk."""
+        def count_round_trips(data):
+            r.flushdb()
+            for listing in data:
+                r.sadd('listings.%s.users' % listing['listing_id'], 1, 2)
+
+            with patch('tasks.get_listing_data', new=Mock(return_value=data)), \
+                    patch.object(
+                        r.connection_pool, 'get_connection',
+                        wraps=r.connection_pool.get_connection,
+                    ) as get_connection:
+                fetch_detail.apply(['1'])
+
+            return get_connection.call_count
+
+        def fake_listing(i):
+            return {
+                'listing_id': str(i),
+                'state': 'active' if i % 3 else 'removed',
+                'quantity': 1,
+                'views': 1,
+                'materials': [],
+                'original_creation_tsz': str(time.time()),
+            }
+
+        small = count_round_trips([fake_listing(i) for i in range(3)])
+        large = count_round_trips([fake_listing(i) for i in range(50)])
+
+        assert small == large
 
 
 class TestFetchDetailDestruction(object):
@@ -329,6 +675,22 @@ class TestFetchDetailDestruction(object):
         assert_does_not_exist('3')
         assert score_listing.called == False
 
+    def test_remembers_inactive(self):
+        """Should remember inactive listings so they aren't fetched again."""
+        self.get_listing_data.return_value = [
+            {
+                'listing_id': '1',
+                'materials': ['fart'],
+                'state': 'butt',
+                'quantity': 1,
+                'views': 1,
+            },
+        ]
+
+        fetch_detail.apply(args=['1'])
+
+        assert negcache.filter_live(['1']) == []
+
     def test_destroy_inactive(self):
         """Should delete everything about an inactive listing."""
         self.get_listing_data.return_value = [
@@ -489,6 +851,239 @@ class TestScoreListing(object):
         assert r.zscore('treasures', '1') > 0
 
 
+def store_unknown_format(listing_id, score=9000):
+    """Stores listing data in a format version from the future."""
+    r.set('listings.%s.data' % listing_id, msgpack.packb(
+        [FORMAT_VERSION + 1] + [None] * len(FIELDS),
+    ))
+    r.zadd('treasures', {listing_id: score})
+
+
+def store_scored(listing_id, created, views=1):
+    """Stores listing data the way fetch_detail does and scores it."""
+    listing = {
+        'listing_id': listing_id,
+        'quantity': 1,
+        'state': 'active',
+        'views': views,
+        'materials': ['gold'] if listing_id % 2 else [],
+        'users': 4,
+        'original_creation_tsz': str(created),
+    }
+
+    r.set('listings.%s.data' % listing_id, json.dumps(listing))
+    score_listing(listing)
+
+
+class TestRescoreTreasures(object):
+    """Tests for rescoring stored listings."""
+    def setup_method(self, method):
+        r.flushdb()
+
+    def teardown_method(self, method):
+        r.flushdb()
+
+    def test_matches_score_listing(self):
+        """Should score stored listings just like score_listing does."""
+        now = time.time()
+        for i in range(20):
+            store_scored(i, now - i * 60 * 60 * 24 * 100, views=i)
+
+        expected = dict(r.zrange('treasures', 0, -1, withscores=True))
+
+        rescore_treasures.apply()
+
+        for listing_id, score in r.zrange('treasures', 0, -1, withscores=True):
+            assert abs(score - expected[listing_id]) < 1e-3
+
+    def test_ages_scores(self):
+        """Should bring scores up to date with the listings' ages."""
+        now = time.time()
+        store_scored(1, now)
+        score = r.zscore('treasures', '1')
+
+        with patch('tasks.time.time', return_value=now + 60 * 60 * 24 * 100):
+            rescore_treasures.apply()
+
+        assert r.zscore('treasures', '1') < score
+
+    def test_skips_recent(self):
+        """Should leave scores alone until the interval has passed."""
+        store_scored(1, time.time())
+        rescore_treasures.apply()
+
+        r.zadd('treasures', {'1': 1})
+        rescore_treasures.apply()
+
+        assert r.zscore('treasures', '1') == 1
+
+    def test_rescores_new_settings(self):
+        """Should rescore straight away when the scoring settings change."""
+        store_scored(1, time.time())
+        rescore_treasures.apply()
+
+        with patch.dict(config, {'BT_USER_WEIGHT': 1}):
+            rescore_treasures.apply()
+
+        assert r.zscore('treasures', '1') < 100
+
+    def test_ignores_purged(self):
+        """Should not score listings without data."""
+        r.zadd('treasures', {'1': 1})
+
+        rescore_treasures.apply()
+
+        assert r.zscore('treasures', '1') == 1
+
+    def test_updates_snapshot(self):
+        """Should rebuild the snapshot with the new ranking."""
+        store_scored(1, time.time())
+
+        rescore_treasures.apply()
+
+        assert json.loads(r.get('treasures.snapshot'))[0]['listing_id'] == 1
+
+    def test_skips_unknown_format(self):
+        """Should skip listings it can't decode, rather than failing."""
+        store_scored(1, time.time())
+        store_unknown_format(2)
+
+        result = rescore_treasures.apply()
+
+        assert result.successful()
+        assert r.zscore('treasures', '2') == 9000
+        assert [
+            treasure['listing_id']
+            for treasure in json.loads(r.get('treasures.snapshot'))
+        ] == [1]
+
+
+class TestMigrateListingData(object):
+    """Tests for rewriting listing data in the compact format."""
+    def setup_method(self, method):
+        r.flushdb()
+
+    def teardown_method(self, method):
+        r.flushdb()
+
+    def test_migrates(self):
+        """Should rewrite whole API listings in the compact format."""
+        now = time.time()
+        for i in range(120):
+            store_scored(i, now)
+
+        with patch.dict(config, {'BT_RESCORE_CHUNK': 50}):
+            migrate_listing_data.apply()
+
+        for i in range(120):
+            data = r.get('listings.%s.data' % i)
+
+            assert not is_legacy(data)
+            assert decode_listing(data)['gold'] == bool(i % 2)
+
+    def test_keeps_compact(self):
+        """Should leave data that's already compact alone."""
+        r.set('listings.1.data', '[1,"compact"]')
+
+        migrate_listing_data.apply()
+
+        assert r.get('listings.1.data') == b'[1,"compact"]'
+
+
+class TestIndexTreasures(object):
+    """Tests for building the sort indexes from stored data."""
+    def setup_method(self, method):
+        r.flushdb()
+
+    def teardown_method(self, method):
+        r.flushdb()
+
+    def test_indexes(self):
+        """Should index every scored listing by each sort field."""
+        now = time.time()
+        for i in range(120):
+            store_scored(i, now, views=i)
+
+        with patch.dict(config, {'BT_RESCORE_CHUNK': 50}):
+            index_treasures.apply()
+
+        for i in range(120):
+            assert r.zscore('treasures.views', i) == i
+            assert r.zscore('treasures.users', i) == 4
+            assert r.zscore('treasures.quantity', i) == 1
+
+    def test_skips_purged(self):
+        """Should not index listings that are no longer scored."""
+        r.set('listings.1.data', json.dumps(listings()[0]))
+
+        index_treasures.apply()
+
+        for field in SORT_FIELDS:
+            assert r.zcard('treasures.%s' % field) == 0
+
+    def test_skips_unknown_format(self):
+        """Should index the listings it can decode."""
+        store_scored(1, time.time())
+        store_unknown_format(2)
+
+        assert index_treasures.apply().successful()
+
+        assert r.zscore('treasures.views', '1') == 1
+        assert r.zscore('treasures.views', '2') is None
+
+
+class TestTrimTreasures(object):
+    """Tests for trimming listings down to the limit."""
+    def setup_method(self, method):
+        r.flushdb()
+
+    def teardown_method(self, method):
+        r.flushdb()
+
+    def test_trims_lowest(self):
+        """Should keep only the highest scored listings."""
+        for i in range(1200):
+            store_fake_data(i, score=i)
+            r.zadd('listings.fetched', {i: 1})
+
+        trim_treasures.apply()
+
+        assert r.zcard('treasures') == config['BT_LISTING_LIMIT']
+        assert r.zcard('listings.fetched') == config['BT_LISTING_LIMIT']
+
+        lowest = 1200 - config['BT_LISTING_LIMIT']
+        for i in range(lowest):
+            assert not r.exists('listings.%s.data' % i)
+            assert r.exists('listings.%s.users' % i)
+
+        for i in range(lowest, 1200):
+            assert r.exists('listings.%s.data' % i)
+
+        for field in SORT_FIELDS:
+            assert r.zcard('treasures.%s' % field) == (
+                config['BT_LISTING_LIMIT']
+            )
+
+    def test_under_limit(self):
+        """Should leave listings alone while under the limit."""
+        for i in range(10):
+            store_fake_data(i, score=i)
+
+        trim_treasures.apply()
+
+        assert r.zcard('treasures') == 10
+        assert r.get('treasures.version') is None
+
+    def test_moves_version(self):
+        """Should move the ranking version on when listings are dropped."""
+        for i in range(config['BT_LISTING_LIMIT'] + 1):
+            store_fake_data(i, score=i)
+
+        trim_treasures.apply()
+
+        assert r.get('treasures.version') == b'1'
+
+
 class TestProcessListings(object):
     """Tests for the process_listings method."""
     def setup_method(self, method):
@@ -511,3 +1106,320 @@ class TestProcessListings(object):
         for mock_call in self.fetch_detail.delay.mock_calls:
             _, args, _ = mock_call
             assert len(args) == 50
+
+    def test_waits_for_full_chunk(self):
+        """Should hold on to listings until a chunk fills up."""
+        process_listings(*range(30))
+
+        assert not self.fetch_detail.delay.called
+
+        process_listings(*range(30, 60))
+
+        assert self.fetch_detail.delay.call_count == 1
+        assert len(self.fetch_detail.delay.call_args[0]) == 50
+        assert r.zcard('listings.pending') == 10
+
+    def test_highest_priority_first(self):
+        """Should send the listings with the most to gain first."""
+        for i in range(60):
+            r.sadd('listings.%s.users' % i, *range(2 + i % 2))
+
+        r.zadd('treasures', {'0': 1})
+        r.zadd('listings.fetched', {'2': time.time() - 60 * 60 * 2})
+
+        process_listings(*range(60))
+
+        chunk = set(self.fetch_detail.delay.call_args[0])
+        remaining = set(
+            listing_id.decode('utf-8')
+            for listing_id in r.zrange('listings.pending', 0, -1)
+        )
+
+        # Odd listings have more users, 0 is visible and 2 was fetched lately
+        assert set(str(i) for i in range(1, 60, 2)) <= chunk
+        assert '0' in chunk
+        assert '2' in remaining
+        assert len(remaining) == 10
+
+    def test_within_budget(self):
+        """Should only send as many chunks as the API budget allows."""
+        with patch('tasks.ratelimit.available', return_value=3):
+            process_listings(*range(500))
+
+        assert self.fetch_detail.delay.call_count == 3
+        assert r.zcard('listings.pending') == 350
+
+    def test_budget_counts_inflight(self):
+        """Should leave budget for chunks that are already in flight."""
+        r.zadd('listings.inflight', {i: time.time() for i in range(1000, 1100)})
+
+        with patch('tasks.ratelimit.available', return_value=3):
+            process_listings(*range(500))
+
+        assert self.fetch_detail.delay.call_count == 1
+
+    def test_marks_inflight(self):
+        """Should mark sent listings as in flight."""
+        process_listings(*range(50))
+
+        assert r.zcard('listings.inflight') == 50
+
+    def test_skips_fresh(self):
+        """Should skip listings that were fetched recently."""
+        r.zadd('listings.fetched', {'1': time.time(), '2': 1})
+
+        process_listings('1', '2')
+
+        assert r.zscore('listings.pending', '1') is None
+        assert r.zscore('listings.pending', '2') is not None
+
+    def test_skips_inflight(self):
+        """Should skip listings that are already being fetched."""
+        r.zadd('listings.inflight', {'1': time.time(), '2': 1})
+
+        process_listings('1', '2')
+
+        assert r.zscore('listings.pending', '1') is None
+        assert r.zscore('listings.pending', '2') is not None
+
+    def test_skips_dead(self):
+        """Should skip listings known to be dead, even if they changed."""
+        negcache.add(['1'])
+
+        process_listings('1', '2', changed=['1'])
+
+        assert r.zscore('listings.pending', '1') is None
+        assert r.zscore('listings.pending', '2') is not None
+
+    def test_forces_changed(self):
+        """Should queue fresh listings whose users changed."""
+        r.zadd('listings.fetched', {'1': time.time()})
+        r.zadd('listings.inflight', {'2': time.time()})
+
+        process_listings('1', '2', changed=['1', '2'])
+
+        assert r.zscore('listings.pending', '1') is not None
+        assert r.zscore('listings.pending', '2') is not None
+
+    def test_forgets_lost_fetches(self):
+        """Should forget in flight listings that never landed."""
+        r.zadd('listings.inflight', {'1': 1})
+
+        flush_listings.apply()
+
+        assert r.zcard('listings.inflight') == 0
+
+    def test_deduplicates(self):
+        """Should only queue each listing once."""
+        process_listings(*range(30))
+        process_listings(*range(30))
+
+        assert r.zcard('listings.pending') == 30
+
+    def test_flushes_after_max_wait(self):
+        """Should send a partial chunk once it has waited long enough."""
+        process_listings(*range(10))
+
+        flush_listings.apply()
+        assert not self.fetch_detail.delay.called
+
+        with patch('tasks.time.time', return_value=time.time() + 3600):
+            flush_listings.apply()
+
+        assert self.fetch_detail.delay.call_count == 1
+        assert len(self.fetch_detail.delay.call_args[0]) == 10
+        assert r.zcard('listings.pending') == 0
+
+
+class TestRefreshTreasures(object):
+    """Tests for keeping the top treasures fresh."""
+    def setup_method(self, method):
+        self.fetch_detail_patch = patch('tasks.fetch_detail')
+        self.fetch_detail = self.fetch_detail_patch.start()
+
+        r.flushdb()
+
+    def teardown_method(self, method):
+        self.fetch_detail_patch.stop()
+
+        r.flushdb()
+
+    def test_refresh_ttl(self):
+        """Should refresh higher ranked listings more often."""
+        window = config['BT_REFRESH_WINDOW']
+
+        assert refresh_ttl(0) == config['BT_REFRESH_MIN_TTL']
+        assert refresh_ttl(window - 1) == config['BT_REFRESH_MAX_TTL']
+        assert refresh_ttl(10) < refresh_ttl(11)
+
+    def test_refreshes_stale(self):
+        """Should queue listings whose data is older than their rank allows."""
+        now = time.time()
+        r.zadd('treasures', {'1': 3, '2': 2, '3': 1})
+        r.zadd('listings.fetched', {
+            '1': now - config['BT_REFRESH_MIN_TTL'] - 60,
+            '2': now - 60,
+        })
+
+        refresh_treasures.apply()
+
+        assert r.zscore('listings.pending', '1') is not None
+        assert r.zscore('listings.pending', '2') is None
+        assert r.zscore('listings.pending', '3') is not None
+
+    def test_rank_dependent(self):
+        """Should keep lower ranked listings for longer."""
+        window = config['BT_REFRESH_WINDOW']
+        fetched = time.time() - config['BT_REFRESH_MIN_TTL'] - 60
+        r.zadd('treasures', {str(i): window - i for i in range(window)})
+        r.zadd('listings.fetched', {str(i): fetched for i in range(window)})
+
+        refresh_treasures.apply()
+
+        assert r.zscore('listings.pending', '0') is not None
+        assert r.zscore('listings.pending', str(window - 1)) is None
+
+    def test_only_window(self):
+        """Should leave listings below the window alone."""
+        window = config['BT_REFRESH_WINDOW']
+        r.zadd('treasures', {str(i): window - i for i in range(window + 1)})
+
+        refresh_treasures.apply()
+
+        assert r.zcard('listings.pending') + (
+            r.zcard('listings.inflight')
+        ) == window
+        assert r.zscore('listings.pending', str(window)) is None
+        assert r.zscore('listings.inflight', str(window)) is None
+
+    def test_skips_inflight(self):
+        """Should not queue listings that are already being fetched."""
+        r.zadd('treasures', {'1': 1})
+        r.zadd('listings.inflight', {'1': time.time()})
+
+        refresh_treasures.apply()
+
+        assert r.zscore('listings.pending', '1') is None
+
+    def test_full_batches(self):
+        """Should fetch refreshed listings in full chunks."""
+        r.zadd('treasures', {str(i): i for i in range(60)})
+
+        refresh_treasures.apply()
+
+        assert self.fetch_detail.delay.call_count == 1
+        assert len(self.fetch_detail.delay.call_args[0]) == 50
+        assert r.zcard('listings.pending') == 10
+
+
+def apply_deltas(previous, deltas):
+    """Applies rank deltas to a list of listing ids, as the browser does."""
+    taken = set(
+        d['listing_id'] for d in deltas if d['op'] in ('remove', 'move')
+    )
+    ranking = [
+        listing_id for listing_id in previous if listing_id not in taken
+    ]
+
+    for delta in deltas:
+        if delta['op'] in ('insert', 'move'):
+            ranking.insert(delta['rank'], delta['listing_id'])
+
+    return ranking
+
+
+class TestBatches(object):
+    """Tests for reading iterables in batches."""
+    def test_batches(self):
+        """Should split an iterable into lists of up to size items."""
+        assert list(batches(iter(range(7)), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+        assert list(batches([], 3)) == []
+
+    def test_lazy(self):
+        """Should only read each batch as it's needed."""
+        read = []
+        numbers = batches((read.append(i) or i for i in range(10)), 4)
+
+        next(numbers)
+
+        assert read == [0, 1, 2, 3]
+
+
+class TestRankDeltas(object):
+    """Tests for publishing changes to the top treasures."""
+    def setup_method(self, method):
+        r.flushdb()
+
+    def teardown_method(self, method):
+        r.flushdb()
+
+    def ranking(self, *listing_ids):
+        return [
+            {'listing_id': listing_id, 'score': 100 - i}
+            for i, listing_id in enumerate(listing_ids)
+        ]
+
+    def test_rebuilds_ranking(self):
+        """Should turn the old ranking into the new one."""
+        previous = [1, 2, 3, 4, 5, 6]
+
+        for current in [
+            [1, 2, 3, 4, 5, 6],
+            [6, 5, 4, 3, 2, 1],
+            [7, 1, 2, 3, 4, 5],
+            [2, 3, 4, 5, 6, 7],
+            [3, 8, 1, 6, 9, 2],
+            [2, 3, 7, 1],
+            [],
+        ]:
+            deltas = rank_deltas(
+                self.ranking(*previous), self.ranking(*current),
+            )
+
+            assert apply_deltas(previous, deltas) == current
+
+    def test_rebuilds_random_rankings(self):
+        """Should turn any old ranking into any new one."""
+        rng = random.Random(0)
+
+        for _ in range(1000):
+            previous = rng.sample(range(20), rng.randint(0, 10))
+            current = rng.sample(range(20), rng.randint(0, 10))
+
+            deltas = rank_deltas(
+                self.ranking(*previous), self.ranking(*current),
+            )
+
+            assert apply_deltas(previous, deltas) == current
+
+    def test_compact(self):
+        """Should only move listings that changed places with others."""
+        deltas = rank_deltas(
+            self.ranking(1, 2, 3, 4, 5),
+            self.ranking(9, 1, 2, 4, 3),
+        )
+
+        assert [(d['op'], d['listing_id']) for d in deltas] == [
+            ('remove', 5), ('insert', 9), ('move', 4),
+        ]
+        assert deltas[1]['listing']['score'] == deltas[1]['score'] == 100
+
+    def test_publishes_deltas(self):
+        """Should publish deltas with the version they lead to."""
+        pubsub = r.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(DELTAS_CHANNEL)
+
+        r.zadd('treasures', {'1': 1})
+        r.set('listings.1.data', encode_listing(listings()[0]))
+
+        update_snapshot()
+
+        message = pubsub.get_message(timeout=1)
+        while message is None:
+            message = pubsub.get_message(timeout=1)
+        delta = json.loads(message['data'])
+        pubsub.close()
+
+        assert delta['version'] == int(r.get('treasures.version')) == 1
+        assert delta['deltas'][0]['op'] == 'insert'
+        assert delta['deltas'][0]['listing_id'] == '1'
@@ -0,0 +1,45 @@
+from db import r
+from listings import decode_stored_listing
+
+
+# Channel the workers publish rank deltas for the top treasures on
+DELTAS_CHANNEL = 'treasures.deltas'
+
+# Listing fields with a sorted set of their own, kept by the workers
+SORT_FIELDS = ('views', 'users', 'quantity')
+
+# Each sort order's sorted set, and whether it's read highest first
+SORTS = {
+    'value': ('treasures', True),
+    'views': ('treasures.views', False),
+    'users': ('treasures.users', True),
+    'quantity': ('treasures.quantity', False),
+}
+
+
+def read_treasures(count, sort='value', client=r):
+    """Reads the top count treasures in a sort order from the data keys.
+
+    Treasures read in value order include their score. Reads through client,
+    the primary unless it's given a replica.
+    """
+    key, descending = SORTS[sort]
+    treasure_ids = (client.zrevrange if descending else client.zrange)(
+        key, 0, count - 1, withscores=True,
+    )
+
+    pipe = client.pipeline()
+    for treasure_id, _ in treasure_ids:
+        pipe.get('listings.' + treasure_id.decode('utf-8') + '.data')
+
+    treasures = []
+    for (treasure_id, score), data in zip(treasure_ids, pipe.execute()):
+        treasure = decode_stored_listing(treasure_id, data)
+        if treasure is None:
+            continue
+
+        if sort == 'value':
+            treasure['score'] = score
+        treasures.append(treasure)
+
+    return treasures